@@ -21,16 +21,20 @@
 # SOFTWARE.
 
 
-import FlowCytometryTools as FCT
-import json, os
+import json, os, hashlib
 from synthetic_circuit_performance import *
 from rank_order_truth_tables import *
+from histogram_cache import file_hash
+from manifest import load_manifest, select
+# transform_data is imported so that automated_pipeline_scoring.transform_data keeps working
+from pipeline_common import transform_args, transform_data, map_files, _transform_file, _hist_file, get_log_values, \
+    bin_data, get_desired_truth_table, score_groups
 import numpy as np
-import pandas as pd
 import ast, random
 
 
-input_states = ["00", "01", "10", "11"]
+# the 2^k input states of a k-input gate; desired_truth_tables are for k = 2
+input_states = get_input_states(2)
 
 
 def get_channels(lab_name):
@@ -48,85 +52,50 @@ def get_channels(lab_name):
     return {"GFP": GFP, "Sytox": Sytox, "FSC": forward_scatter}
 
 
-def transform_data(fname,transform,channels,threshold,channel,region):
-    #Transform and gate using flowcytometrytools
-    sample = FCT.FCMeasurement(ID="temp", datafile=fname)
-    if transform == 'hlog':
-        # see FlowCytometryTools documentation
-        sample = sample.transform(transform, channels=[c for _, c in channels.items()], b=100)
-    elif transform == 'tlog':
-        sample = sample.transform(transform, channels=[c for _, c in channels.items()], th=2)
-    elif transform is not None:
-        raise ValueError("Transform {} not recognized.".format(transform))
-    if threshold:
-        try:
-            gate = FCT.ThresholdGate(threshold, [channels[channel]], region=region)
-            sample = sample.gate(gate)
-        except:
-            print(fname)
-            print(sample.channel_names)
-            raise
-    return sample
+def select_rows_tx(manifest, circuit):
+    # Manifest positions of the strain files (not beads, not wild type) of a circuit or list of circuits
+    return select(manifest, bead=False, circuit=circuit, input_state=lambda s: s != "")
+
+
+def get_files_tx(circuit,ingest_file="transcriptic_april_fcsfiles_dan.csv", prefix="~/sd2e-community", manifest=None):
+    # Selects the files of a circuit, or of a list of circuits, from the manifest index of
+    # transcriptic_april_fcsfiles_dan.csv (see manifest.py). Returns (experiment, fname, channels, metadata) for each
+    # file. Pass manifest to reuse an already loaded index.
+    if manifest is None:
+        manifest = load_manifest(ingest_file, prefix)
+    files = []
+    for i in select_rows_tx(manifest, circuit):
+        channels = get_channels("Transcriptic")
+        channels.pop("Sytox")
+        metadata = {'media': str(manifest["media"][i]), 'circuit': str(manifest["circuit"][i]), 'od': float(manifest["od"][i]),
+                    'input_state': str(manifest["input_state"][i]), 'rep': float(manifest["rep"][i])}
+        files.append((str(manifest["experiment"][i]), str(manifest["path"][i]), channels, metadata))
+    return files
 
 
-def get_data_tx(circuit,ingest_file="transcriptic_april_fcsfiles_dan.csv", prefix="~/sd2e-community", transform='hlog',threshold=4000,channel="FSC",region="above"):
-    # Parses transcriptic_april_fcsfiles_dan.csv exactly.
-    df = pd.read_csv(open(ingest_file))
+def get_data_tx(circuit,ingest_file="transcriptic_april_fcsfiles_dan.csv", prefix="~/sd2e-community", transform='hlog',threshold=4000,channel="FSC",region="above",workers=1,backend="fct"):
+    # Load, transform and gate the files of one circuit. With workers > 1 the files are processed on a process pool,
+    # and the result is the same as the serial one (same order within each experiment).
+    files = get_files_tx(circuit,ingest_file,prefix)
+    jobs = [(fname, transform, channels, threshold, channel, region, backend) for _, fname, channels, _ in files]
     data = {}
     count = 0
-    for index, row in df.iterrows():
-        if pd.isnull(row["bead"]):
-            c = getcircuit(row["gate"])
-            if c == circuit:
-                lab_name = "Transcriptic"
-                channels = get_channels(lab_name)
-                fname = ast.literal_eval(row["fcs_files"])[0]
-                fname = os.path.join(os.path.expanduser(prefix), "/".join(fname.split('/')[3:]))
-                media = row["media"].split('/')[-2]
-                try:
-                    input_state = "".join([str(s) for s in ast.literal_eval(row["input"])])
-                except:
-                    # wild type has no input state
-                    continue
-                rep = row["replicate"]
-                od = row["od"]
-                metadata = {'media': media, 'circuit': circuit, 'od': od, 'input_state': input_state, 'rep': rep}
-                channels.pop("Sytox")
-                sample = transform_data(fname, transform, channels, threshold,channel,region)
-                d = fname.split('/')[-4]
-                if d in data:
-                    data[d].append((sample, channels, metadata))
-                else:
-                    data[d] = [(sample, channels, metadata)]
-                count += 1
-                if not count % 100:
-                    print(count)
+    for (d, fname, channels, metadata), sample in zip(files, map_files(_transform_file, jobs, workers)):
+        if d in data:
+            data[d].append((sample, channels, metadata))
+        else:
+            data[d] = [(sample, channels, metadata)]
+        count += 1
+        if not count % 100:
+            print("{}/{}".format(count,len(files)))
     print("Total files chosen = {}".format(count))
     return data
 
 
-def bin_data(pts, bin_endpoints):
-    hist = [0] * (len(bin_endpoints) + 1)
-    for p in list(pts):
-        ind = sorted(list(bin_endpoints) + [p]).index(p)
-        hist[ind] += 1
-    return hist
-
-
 def get_bin_centers(bin_endpoints):
     return [a + (b - a) / 2 for (a, b) in zip([0] + list(bin_endpoints), list(bin_endpoints) + [2 * bin_endpoints[-1] - bin_endpoints[-2]])]
 
 
-def get_log_values(values):
-    log_vals = []
-    for v in values:
-        if v > 0:
-            log_vals.append(np.log10(v))
-        else:
-            log_vals.append(-1)
-    return np.asarray(log_vals)
-
-
 def sort_strains_into_histograms(data, bin_endpoints):
     # Data transformation and reorganization
     circuits = {}
@@ -135,16 +104,62 @@ def sort_strains_into_histograms(data, bin_endpoints):
             ip = metadata["input_state"]
             metadata.pop("input_state")
             metadata=str(metadata)
-            pts = get_log_values(sample.data[channels["GFP"]].values.transpose())
+            pts = get_log_values(np.asarray(sample.data[channels["GFP"]]))
             hist = np.asarray(bin_data(pts, bin_endpoints))
             if metadata not in circuits:
-                circuits[metadata] = {"00": [], "01": [], "10": [], "11": []}
+                circuits[metadata] = {k: [] for k in input_states}
             circuits[metadata][ip].append(hist)
     return circuits
 
 
-def get_results(hists, bin_centers, num_choices):
-    # Record separation scores and whether they are associated to the desired truth table or not.
+def get_hists_tx(circuit, bin_endpoints, ingest_file="transcriptic_april_fcsfiles_dan.csv", prefix="~/sd2e-community", transform='hlog',threshold=4000,channel="FSC",region="above",workers=1,cachedir=None,backend="fct",manifest=None):
+    '''
+    Streaming version of sort_strains_into_histograms(get_data_tx(...), bin_endpoints). Each file is loaded, transformed,
+    gated, logged and binned and then dropped, so only histograms and metadata are kept and peak memory is bounded by
+    the number of worker processes instead of the number of files.
+
+    :param cachedir: optional directory of cached histograms; files whose histogram is cached are not parsed
+    :param manifest: optional manifest index already loaded with load_manifest
+    :return: the same dictionary as sort_strains_into_histograms
+    '''
+    files = get_files_tx(circuit,ingest_file,prefix,manifest)
+    return sort_file_hists(files, iter_file_hists(files, bin_endpoints, transform, threshold, channel, region, workers,
+                                                  cachedir, backend))
+
+
+def iter_file_hists(files, bin_endpoints, transform='hlog',threshold=4000,channel="FSC",region="above",workers=1,cachedir=None,backend="fct"):
+    # Yield the histogram of each of files (output of get_files_tx) in order, see get_hists_tx
+    jobs = [(fname, transform, channels, threshold, channel, region, backend, bin_endpoints, cachedir)
+            for _, fname, channels, _ in files]
+    count = 0
+    for hist in map_files(_hist_file, jobs, workers):
+        yield hist
+        count += 1
+        if not count % 100:
+            print("{}/{}".format(count,len(files)))
+    print("Total files chosen = {}".format(count))
+
+
+def sort_file_hists(files, hists):
+    # Sort the histograms of files (output of get_files_tx) in the same order as sort_strains_into_histograms, which
+    # goes through the experiments in turn
+    experiments = {}
+    for (d, fname, channels, metadata), hist in zip(files, hists):
+        experiments.setdefault(d, []).append((hist, metadata))
+    circuits = {}
+    for d, hists in experiments.items():
+        for hist, metadata in hists:
+            metadata = metadata.copy()
+            ip = metadata.pop("input_state")
+            metadata = str(metadata)
+            if metadata not in circuits:
+                circuits[metadata] = {k: [] for k in input_states}
+            circuits[metadata][ip].append(hist)
+    return circuits
+
+
+def pool_replicates(hists):
+    # Pool the histograms of all replicates and optical densities of each (circuit, media) group
     new_circuits = {}
     for metadata, vals in hists.items():
         metadata = ast.literal_eval(metadata)
@@ -162,16 +177,28 @@ def get_results(hists, bin_centers, num_choices):
         else:
             temp = dict(new_circuits[md])
             new_circuits[md] = {k: temp.get(k) + vals.get(k) for k in vals.keys()}
+    return new_circuits
+
+
+def get_results(hists, bin_centers, num_choices, batched=False, seed=None, workers=1, tol=None, median_tol=None):
+    # Record separation scores and whether they are associated to the desired truth table or not.
+    # With batched=True or a seed (int, numpy SeedSequence or Generator), each group draws from its own numpy stream
+    # derived from seed and the group key, and all draws are scored with bootstrap_groups on workers processes. The
+    # result is reproducible, the same for any number of workers and does not depend on the other groups. Otherwise the
+    # draws come from the random module and workers is not used.
+    # With a tolerance tol, num_choices is the average budget per group and each group stops drawing once its fraction
+    # correct is known to within tol and its median separation to within median_tol, which is in units of the
+    # separation and defaults to tol (see bootstrap_groups_adaptive).
+    new_circuits = pool_replicates(hists)
+    if batched or seed is not None or tol is not None:
+        return score_groups(new_circuits, bin_centers, num_choices, seed, workers, tol, median_tol)
     all_scores = {md: {'truthtable_incorrect': [], 'truthtable_correct': []} for md in new_circuits}
     for md, ip in new_circuits.items():
-        for m in md:
-            if m[0] == "circuit":
-                desiredtt = desired_truth_tables[m[1]]
-                break
+        desiredtt = get_desired_truth_table(md)
         truthtable_incorrect = []
         truthtable_correct = []
         for _ in range(num_choices):
-            choice = [np.asarray(random.choice(ip[input_states[k]])) for k in range(4)]
+            choice = [np.asarray(random.choice(ip[input_states[k]])) for k in range(len(input_states))]
             d = dict(zip(input_states, choice))
             scores = rank_noncst_tables(d, bin_centers)
             try:
@@ -187,7 +214,7 @@ def get_results(hists, bin_centers, num_choices):
     return all_scores
 
 
-def main_tx(circuit,ingest_file="transcriptic_april_fcsfiles_dan.csv",bin_endpoints=[np.log10(r) for r in range(250, 10250, 250)], num_choices=250):
+def main_tx(circuit,ingest_file="transcriptic_april_fcsfiles_dan.csv",bin_endpoints=[np.log10(r) for r in range(250, 10250, 250)], num_choices=250, workers=1, stream=False, cachedir=None, backend="fct", batched=False, seed=None, tol=None, score_workers=1, median_tol=None):
     '''
     This function works only for files in the format transcriptic_april_fcsfiles_dan.csv. There are also multiple
     default arguments in this script that came from looking at data.
@@ -198,17 +225,200 @@ def main_tx(circuit,ingest_file="transcriptic_april_fcsfiles_dan.csv",bin_endpoi
     :param num_choices: how many circuits to measure based on pooling replicates and optical densities for a fixed
     circuit, media condition, and experiment. The circuits are constructed by randomly picking each strain from the
     pooled data (pick a 00 from all the 00 strains, pick 01 from all the 01 strains, etc)
+    :param workers: number of processes used to ingest the FCS files
+    :param stream: if True, keep only the histogram of each file instead of the full samples (see get_hists_tx)
+    :param cachedir: optional directory of cached per-file histograms, used when stream is True
+    :param backend: "fct" to read files with FlowCytometryTools, "native" to use fcsreader, "numpy" to use fcsreader
+    and the fcs_transforms transform and gate
+    :param batched: if True, score the random circuits of each group together (see get_results)
+    :param seed: seed for the random circuits (see get_results)
+    :param tol: if given, stop drawing random circuits for a group once its fraction correct is known to within tol,
+    with num_choices as the average budget per group (see get_results)
+    :param median_tol: tolerance of the median separation when tol is given; default tol (see get_results)
+    :param score_workers: number of processes used to score the random circuits when batched, seed or tol is given
     :return: Separation scores and whether they are associated to the desired truth table are saved to a file.
     '''
     bin_centers = np.asarray(get_bin_centers(bin_endpoints))
     print("Getting data for circuit {}....".format(circuit))
-    data = get_data_tx(circuit,ingest_file=ingest_file)
-    print("Initial sort for circuit {}....".format(circuit))
-    h = sort_strains_into_histograms(data, bin_endpoints)
-    print("Initial sort done.")
+    if stream:
+        h = get_hists_tx(circuit, bin_endpoints, ingest_file=ingest_file, workers=workers, cachedir=cachedir,
+                         backend=backend)
+    else:
+        data = get_data_tx(circuit,ingest_file=ingest_file,workers=workers,backend=backend)
+        print("Initial sort for circuit {}....".format(circuit))
+        h = sort_strains_into_histograms(data, bin_endpoints)
+        print("Initial sort done.")
     print("Processing results for {}....".format(circuit))
-    results = get_results(h, bin_centers, num_choices=num_choices)
+    results = get_results(h, bin_centers, num_choices=num_choices, batched=batched, seed=seed,
+                          workers=score_workers, tol=tol, median_tol=median_tol)
     print("Processing results done.")
     savefile = "temp_output_{}.json".format(circuit)
     json.dump({str(k) : r for k,r in results.items()}, open(savefile, "w"))
     print("Output saved to {}".format(savefile))
+
+
+def main_all(circuits=None,ingest_file="transcriptic_april_fcsfiles_dan.csv",bin_endpoints=[np.log10(r) for r in range(250, 10250, 250)], num_choices=250, workers=1, cachedir=None, backend="fct", seed=None, prefix="~/sd2e-community", tol=None, median_tol=None):
+    '''
+    main_tx for several circuits in one pass. The manifest is loaded once, the histograms of the files of all circuits
+    are made in one pass over a process pool, and then the draws of every (circuit, media) group are scored together on
+    a process pool with score_groups. Results are saved per circuit in the same format as main_tx.
+
+    :param circuits: list of circuits, default all of desired_truth_tables
+    :param seed: seed of the random circuits; each group gets an independent stream derived from it and the group key
+    (see keyed_seeds)
+    :param tol: optional tolerance for adaptive stopping of the random circuits (see get_results)
+    :param median_tol: tolerance of the median separation when tol is given (see get_results)
+    :return: Separation scores are saved to temp_output_{circuit}.json for each circuit.
+    See main_tx for the other parameters.
+    '''
+    if circuits is None:
+        circuits = list(desired_truth_tables)
+    bin_centers = np.asarray(get_bin_centers(bin_endpoints))
+    print("Getting data for circuits {}....".format(circuits))
+    manifest = load_manifest(ingest_file, prefix)
+    files = get_files_tx(circuits, ingest_file, prefix, manifest)
+    hists = list(iter_file_hists(files, bin_endpoints, workers=workers, cachedir=cachedir, backend=backend))
+    groups = []
+    for circuit in circuits:
+        selected = [(f, h) for f, h in zip(files, hists) if f[3]["circuit"] == circuit]
+        h = sort_file_hists([f for f, _ in selected], [h for _, h in selected])
+        groups.extend((circuit, md, ip) for md, ip in pool_replicates(h).items())
+    print("Processing results for {} groups....".format(len(groups)))
+    scores = score_groups(dict((md, ip) for _, md, ip in groups), bin_centers, num_choices, seed, workers, tol,
+                          median_tol)
+    results = {circuit: {} for circuit in circuits}
+    for circuit, md, _ in groups:
+        results[circuit][md] = scores[md]
+    print("Processing results done.")
+    for circuit in circuits:
+        savefile = "temp_output_{}.json".format(circuit)
+        json.dump({str(k) : r for k,r in results[circuit].items()}, open(savefile, "w"))
+        print("Output saved to {}".format(savefile))
+
+
+def incremental_key(bin_endpoints, transform, threshold, channel, region, backend):
+    params = {"transform": transform, "transform_args": transform_args.get(transform), "threshold": threshold,
+              "channel": channel, "region": region, "backend": backend,
+              "bin_endpoints": [repr(float(e)) for e in bin_endpoints]}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def read_histogram_log(fname, key):
+    '''
+    Read the append-only histogram log of main_incremental. The first line is a header with the processing settings,
+    every other line is the histogram of one manifest row keyed by its id and file hash. A partially written last
+    line (from a killed job) is ignored.
+
+    :return: dictionary of histograms keyed by (id, file hash)
+    '''
+    hists = {}
+    if not os.path.exists(fname):
+        return hists
+    with open(fname) as f:
+        lines = f.readlines()
+    if lines:
+        header = json.loads(lines[0])
+        if header["key"] != key:
+            raise ValueError("Histogram log {} was written with different processing settings.".format(fname))
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        hists[(record["id"], record["hash"])] = np.asarray(record["hist"])
+    return hists
+
+
+def main_incremental(statedir, circuits=None, ingest_file="transcriptic_april_fcsfiles_dan.csv",bin_endpoints=[np.log10(r) for r in range(250, 10250, 250)], num_choices=250, workers=1, cachedir=None, backend="fct", seed=None, prefix="~/sd2e-community", transform='hlog', threshold=4000, channel="FSC", region="above", tol=None, median_tol=None):
+    '''
+    main_all that only processes what changed since the last run with the same statedir. The histogram of every
+    manifest row is recorded in statedir/histograms.jsonl by row id and file hash, so only new rows (or rows whose file
+    changed) are ingested. The (circuit, media) pools are rebuilt from the stored histograms, and a group is re-scored
+    only if its members differ from those recorded in statedir/scores.json; the other groups keep their scores. All
+    groups are re-scored when num_choices, seed, tol or median_tol differ from the recorded ones.
+    If the processing settings differ from those of the log, the old log is moved to histograms.jsonl.old and a new
+    one is started.
+
+    :param statedir: directory holding the histogram log and the scores of previous runs
+    See main_all for the other parameters.
+    :return: list of the groups that were scored. Separation scores of all groups are saved to
+    temp_output_{circuit}.json for each circuit.
+    '''
+    if circuits is None:
+        circuits = list(desired_truth_tables)
+    statedir = os.path.expanduser(statedir)
+    if not os.path.exists(statedir):
+        os.makedirs(statedir)
+    histlog = os.path.join(statedir, "histograms.jsonl")
+    scorefile = os.path.join(statedir, "scores.json")
+    key = incremental_key(bin_endpoints, transform, threshold, channel, region, backend)
+    root = seed_sequence(seed)
+    # with seed=None the draws are not reproducible anyway, so any earlier unseeded scores are kept
+    scoring = {"num_choices": num_choices, "tol": tol, "median_tol": median_tol,
+               "seed": None if seed is None else [str(root.entropy), list(root.spawn_key)]}
+    bin_centers = np.asarray(get_bin_centers(bin_endpoints))
+    manifest = load_manifest(ingest_file, prefix)
+    files = get_files_tx(circuits, ingest_file, prefix, manifest)
+    tokens = [(str(i), file_hash(f[1])) for i, f in zip(manifest["id"][select_rows_tx(manifest, circuits)], files)]
+    try:
+        stored = read_histogram_log(histlog, key)
+    except ValueError:
+        # different processing settings: keep the old log aside and start over
+        print("Processing settings changed, moving {} to {}.old.".format(histlog, histlog))
+        os.replace(histlog, histlog + ".old")
+        stored = {}
+    new = [(t, f) for t, f in zip(tokens, files) if t not in stored]
+    print("{} of {} files are new.".format(len(new), len(files)))
+    torn = False
+    if os.path.exists(histlog) and os.path.getsize(histlog):
+        with open(histlog,'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
+    with open(histlog,'a') as f:
+        if torn:
+            # terminate the partial record of a killed run so the next record starts on its own line
+            f.write("\n")
+        if not f.tell():
+            f.write(json.dumps({"key" : key}) + "\n")
+        new_hists = iter_file_hists([nf for _, nf in new], bin_endpoints, transform, threshold, channel, region,
+                                    workers, cachedir, backend)
+        for (t, _), hist in zip(new, new_hists):
+            f.write(json.dumps({"id" : t[0], "hash" : t[1], "hist" : np.asarray(hist).tolist()}) + "\n")
+            f.flush()
+            stored[t] = np.asarray(hist)
+    previous = {}
+    if os.path.exists(scorefile):
+        with open(scorefile) as f:
+            previous = json.load(f)
+        previous = previous["groups"] if previous["key"] == key and previous.get("scoring") == scoring else {}
+    groups = []
+    for circuit in circuits:
+        selected = [(f, t) for f, t in zip(files, tokens) if f[3]["circuit"] == circuit]
+        members = pool_replicates(sort_file_hists([f for f, _ in selected], [list(t) for _, t in selected]))
+        for md, ip in members.items():
+            groups.append((circuit, md, ip))
+    pools, changed = {}, []
+    for circuit, md, ip in groups:
+        if str(md) in previous and previous[str(md)]["members"] == ip:
+            continue
+        pools[md] = {k: [stored[tuple(t)] for t in ip[k]] for k in ip}
+        changed.append(str(md))
+    print("Processing results for {} of {} groups....".format(len(pools), len(groups)))
+    scores = dict((str(md), s) for md, s in score_groups(pools, bin_centers, num_choices, root, workers, tol,
+                                                             median_tol).items())
+    print("Processing results done.")
+    results = {circuit: {} for circuit in circuits}
+    state = dict(previous)
+    for circuit, md, ip in groups:
+        r = scores[str(md)] if str(md) in scores else previous[str(md)]["scores"]
+        results[circuit][str(md)] = r
+        state[str(md)] = {"members": ip, "scores": r}
+    tmp = scorefile + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"key": key, "scoring": scoring, "groups": state}, f)
+    os.replace(tmp, scorefile)
+    for circuit in circuits:
+        savefile = "temp_output_{}.json".format(circuit)
+        json.dump(results[circuit], open(savefile, "w"))
+        print("Output saved to {}".format(savefile))
+    return changed
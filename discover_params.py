@@ -20,8 +20,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import DSGRN,json,sqlite3
+import DSGRN,json,sqlite3,itertools
+from collections import OrderedDict
+import numpy as np
 from truth_table_fixed_pts import do_all_queries
+from paramio import load_params
 
 
 def dict_of_behavior(node_type,hex):
@@ -138,17 +141,176 @@ def get_hex(pind,pg):
     return [q.hex() for q in pg.parameter(pind).logic()]
 
 
-def get_one_change_params(logic,out="GFP",topvalout=1,print_output=True):
+def iter_one_change_hexes(pg,summary,params,design_spec,max_hits=None,cache_size=100000):
     '''
+    Stream the parameters whose logic hex codes differ from the design spec in exactly one position. The hex codes of
+    the cache_size most recently seen parameter indices are kept, so an index that matches several truth tables is
+    usually decoded once while memory stays bounded.
+
+    :param pg: DSGRN.ParameterGraph of the network.
+    :param summary: The summary dictionary written by do_all_queries.
+    :param params: The corresponding dictionary of parameter indices (json or binary params file).
+    :param design_spec: List of hex codes of the designed circuit.
+    :param max_hits: Stop after this many hits. None for no limit.
+    :param cache_size: Maximum number of parameter indices whose hex codes are kept.
+    :return: A generator of (truth table key, parameter index, list of hex codes) tuples.
+    '''
+    hexes = OrderedDict()
+    hits = 0
+    for s,v in summary.items():
+        try:
+            w = int(v[0])
+        except:
+            continue
+        if w > 0:
+            for p in params[s]:
+                p = int(p)
+                if p in hexes:
+                    hexes.move_to_end(p)
+                else:
+                    hexes[p] = get_hex(p,pg)
+                    if len(hexes) > cache_size:
+                        hexes.popitem(last=False)
+                if sum([1 for h,d in zip(hexes[p],design_spec) if h != d]) == 1:
+                    yield s, p, hexes[p]
+                    hits += 1
+                    if max_hits and hits >= max_hits:
+                        return
+
+
+def iter_one_change_params(logic,out="GFP",topvalout=1,print_output=False,fmt="json",max_hits=None):
+    '''
+    Streaming version of get_one_change_params that yields hits as they are found.
 
     :param logic: A function handle specifying one of the logics in this module.
+    :param fmt: "json" or "binary", the format of the params file written by do_all_queries.
+    :param max_hits: Stop after this many hits. None for no limit.
+    :return: A generator of (truth table key, parameter index, list of hex codes) tuples.
+    '''
+    dbname, in1, topval1, in2, topval2, design_spec = logic()[:6]
+    sfile, pfile = do_all_queries(dbname, in1, topval1, in2, topval2, out, topvalout, print_output, fmt=fmt)
+    summary = json.load(open(sfile))
+    params = load_params(pfile)
+    pg = DSGRN.ParameterGraph(DSGRN.Network(get_network(dbname)))
+    for hit in iter_one_change_hexes(pg,summary,params,design_spec,max_hits):
+        yield hit
+
+
+def get_hex_index(pg):
+    '''
+    Index the logic hex codes of each node using the mixed radix structure of the parameter graph. A parameter index
+    factors as L + (number of logic combinations) * O, where O enumerates the orderings and
+    L = sum over nodes d of (logic index of d) * (product of the logic sizes of the nodes before d).
+
+    :param pg: DSGRN.ParameterGraph
+    :return: A dictionary with the hex codes of each node ordered by logic index ("hexes"), the place value of each
+             node's logic index ("place"), and the number of logic combinations ("logic_size").
+    '''
+    D = len(pg.parameter(0).logic())
+    sizes = [pg.logicsize(d) for d in range(D)]
+    place = [int(np.prod(sizes[:d], dtype=np.uint64)) for d in range(D)]
+    base = get_hex(0,pg)
+    hexes = []
+    for d in range(D):
+        node_hexes = []
+        for i in range(sizes[d]):
+            hexlist = get_hex(i * place[d],pg)
+            if any(h != b for e,(h,b) in enumerate(zip(hexlist,base)) if e != d):
+                raise ValueError("The parameter graph does not have the expected mixed radix structure.")
+            node_hexes.append(hexlist[d])
+        # if the logic index of d were not in these digits, every index above would decode to the base hex code
+        if len(set(node_hexes)) != sizes[d]:
+            raise ValueError("The parameter graph does not have the expected mixed radix structure.")
+        hexes.append(node_hexes)
+    logic_size = int(np.prod(sizes, dtype=np.uint64))
+    if pg.size() % logic_size:
+        raise ValueError("The parameter graph does not have the expected mixed radix structure.")
+    # round trip an index with the last logic of every node and a nonzero order part
+    L = sum((s - 1) * p for s, p in zip(sizes, place))
+    O = pg.size() // logic_size - 1
+    if get_hex(L + logic_size * O,pg) != [node_hexes[-1] for node_hexes in hexes]:
+        raise ValueError("The parameter graph does not have the expected mixed radix structure.")
+    return {"hexes" : hexes, "place" : place, "logic_size" : logic_size, "size" : pg.size()}
+
+
+def logic_indices(hex_index,hexlist):
+    # logic index of each hex code at its node, or -1 if the node has no such hex code (e.g. incomplete design specs)
+    return [node_hexes.index(h) if h in node_hexes else -1 for node_hexes,h in zip(hex_index["hexes"],hexlist)]
+
+
+def iter_hamming_params(hex_index,design_spec,k):
+    '''
+    Enumerate all parameters whose logic differs from the design spec at exactly k nodes, without decoding any
+    parameter.
+
+    :param hex_index: The output of get_hex_index.
+    :param design_spec: List of hex codes of the designed circuit.
+    :param k: Number of nodes whose hex code differs from design_spec.
+    :return: A generator of (list of hex codes, range of parameter indices with those hex codes) pairs.
+    '''
+    design = logic_indices(hex_index,design_spec)
+    hexes = hex_index["hexes"]
+    for nodes in itertools.combinations(range(len(hexes)),k):
+        alternatives = [[i for i in range(len(hexes[d])) if i != design[d]] for d in nodes]
+        for choice in itertools.product(*alternatives):
+            logic = list(design)
+            for d,i in zip(nodes,choice):
+                logic[d] = i
+            if any(i < 0 for i in logic):
+                continue
+            L = sum(i * p for i,p in zip(logic,hex_index["place"]))
+            yield [hexes[d][i] for d,i in enumerate(logic)], range(L, hex_index["size"], hex_index["logic_size"])
+
+
+def hamming_distances(hex_index,params,design_spec):
+    '''
+    :param hex_index: The output of get_hex_index.
+    :param params: An iterable of parameter indices.
+    :param design_spec: List of hex codes of the designed circuit.
+    :return: A numpy array with the number of nodes at which the logic of each parameter differs from design_spec.
+    '''
+    params = np.asarray(params, dtype=np.uint64) % np.uint64(hex_index["logic_size"])
+    distances = np.zeros(len(params), dtype=int)
+    for d,(i,p) in enumerate(zip(logic_indices(hex_index,design_spec),hex_index["place"])):
+        distances += (params // np.uint64(p)) % np.uint64(len(hex_index["hexes"][d])) != i
+    return distances
+
+
+def get_k_change_params(summary,params,design_spec,hex_index,k=1):
+    '''
+    Find the parameters of each truth table whose hex codes differ from the design spec at exactly k nodes.
+
+    :param summary: The summary dictionary written by do_all_queries.
+    :param params: The corresponding dictionary of parameter indices (json or binary params file).
+    :param design_spec: List of hex codes of the designed circuit.
+    :param hex_index: The output of get_hex_index.
+    :param k: Number of changes from design_spec.
+    :return: A dictionary of truth table keys mapping to arrays of parameter indices.
+    '''
+    k_change_params = {}
+    for s,v in summary.items():
+        try:
+            w = int(v[0])
+        except:
+            continue
+        if w > 0:
+            p = np.asarray(params[s], dtype=np.uint64)
+            k_change_params[s] = p[hamming_distances(hex_index,p,design_spec) == k]
+    return k_change_params
+
+
+def get_one_change_params(logic,out="GFP",topvalout=1,print_output=True,fmt="json"):
+    '''
+
+    :param logic: A function handle specifying one of the logics in this module.
+    :param fmt: "json" or "binary", the format of the params file written by do_all_queries.
     :return: A dictionary of truth tables and parameters counts, a corresponding dictionary of the parameter indices, and a dictionary of the most parsimonious hex codes for each truth table (the hex codes where there is exactly one change from design spec.
     '''
     dbname, in1, topval1, in2, topval2, design_spec = logic()
-    sfile, pfile = do_all_queries(dbname, in1, topval1, in2, topval2, out, topvalout, print_output)
+    sfile, pfile = do_all_queries(dbname, in1, topval1, in2, topval2, out, topvalout, print_output, fmt=fmt)
 
     summary = json.load(open(sfile))
-    params = json.load(open(pfile))
+    params = load_params(pfile)
 
     pg = DSGRN.ParameterGraph(DSGRN.Network(get_network(dbname)))
 
@@ -159,11 +321,7 @@ def get_one_change_params(logic,out="GFP",topvalout=1,print_output=True):
         except:
             continue
         if w > 0:
-            hlist=[]
-            for p in params[s]:
-                hexlist = get_hex(p,pg)
-                if sum([1 for h,d in zip(hexlist,design_spec) if h != d]) == 1:
-                    hlist.append(hexlist)
-            one_change_hexes.update({s : hlist})
+            one_change_hexes.update({s : []})
+    for s, p, hexlist in iter_one_change_hexes(pg,summary,params,design_spec):
+        one_change_hexes[s].append(hexlist)
     return summary,params,one_change_hexes
-
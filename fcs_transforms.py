@@ -0,0 +1,150 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Bree Cummins
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import time
+import numpy as np
+
+# NumPy versions of the FlowCytometryTools hlog and tlog transforms and of its threshold gate. hlog has no closed
+# form (FlowCytometryTools inverts hlog_inv numerically), so it is read off a precomputed table. The table is uniform in
+# arcsinh(x / b), which follows the linear-then-log shape of hlog, so the table position of a value is computed
+# directly instead of searched for. The defaults of r and d are the FlowCytometryTools defaults.
+
+display_max = 10 ** 4
+log_machine_max = np.log10(2 ** 18)
+
+_hlog_tables = {}
+
+
+def hlog_inv(y, b=500, r=display_max, d=log_machine_max):
+    aux = 1. * d / r * np.asarray(y, dtype=float)
+    s = np.where(aux < 0, -1., 1.)
+    return s * 10 ** (s * aux) + b * aux - s
+
+
+def hlog_table(b, r=display_max, d=log_machine_max, size=2 ** 16):
+    '''
+    Tabulate hlog for x = b * sinh(u), u uniform, over the values whose hlog is in [-2r, 2r], which is where
+    FlowCytometryTools looks for the inverse. Tables are cached by parameter value.
+
+    :return: (u0, du, y) with y[k] = hlog(b * sinh(u0 + k * du))
+    '''
+    key = (b, r, d, size)
+    if key not in _hlog_tables:
+        # invert hlog_inv on a fine grid of transformed values, then resample on the arcsinh grid
+        y_fine = np.linspace(-2 * r, 2 * r, 16 * size)
+        x_fine = hlog_inv(y_fine, b, r, d)
+        u = np.linspace(np.arcsinh(x_fine[0] / b), np.arcsinh(x_fine[-1] / b), size)
+        _hlog_tables[key] = (u[0], u[1] - u[0], np.interp(b * np.sinh(u), x_fine, y_fine))
+    return _hlog_tables[key]
+
+
+def hlog(x, b=500, r=display_max, d=log_machine_max):
+    # linear interpolation in the table; values outside the table are clamped to [-2r, 2r]
+    u0, du, y = hlog_table(b, r, d)
+    x = np.asarray(x, dtype=float)
+    pos = np.arcsinh(x.reshape(-1) / b)
+    pos -= u0
+    pos /= du
+    np.clip(pos, 0, len(y) - 1, out=pos)
+    k = np.minimum(pos.astype(np.intp), len(y) - 2)
+    pos -= k
+    out = y[k]
+    out += pos * (y[k + 1] - out)
+    return out.reshape(x.shape)
+
+
+def tlog(x, th=1, r=display_max, d=log_machine_max):
+    if th <= 0:
+        raise ValueError('Threshold value must be positive. %s given.' % th)
+    return np.log10(np.maximum(x, th)) * 1. * r / d
+
+
+transforms = {'hlog': hlog, 'tlog': tlog}
+
+
+def transform_and_gate(data, transform, transform_args, d, threshold, gate_channel, region):
+    '''
+    Transform the channels in data and apply a threshold gate in one pass. The gate channel is transformed first and
+    the other channels are transformed only at the events that pass the gate.
+
+    :param data: dictionary of channel names mapping to 1-D arrays of raw values
+    :param transform: 'hlog', 'tlog' or None
+    :param transform_args: dictionary of transform parameters, e.g. {'b': 100}
+    :param d: log10 of the data range of the channels ($PnR)
+    :param threshold: threshold on the transformed gate channel; None or 0 for no gate
+    :param gate_channel: name of the gated channel
+    :param region: 'above' (passes values >= threshold, as ThresholdGate) or 'below'
+    :return: dictionary of channel names mapping to transformed, gated arrays
+    '''
+    if transform is None:
+        fun = lambda x: np.asarray(x, dtype=float)
+    elif transform in transforms:
+        fun = lambda x: transforms[transform](x, d=d, **transform_args)
+    else:
+        raise ValueError("Transform {} not recognized.".format(transform))
+    if not threshold:
+        return {c: fun(v) for c, v in data.items()}
+    gated = fun(data[gate_channel])
+    passed = gated >= threshold
+    if region == "below":
+        passed = ~passed
+    return {c: gated[passed] if c == gate_channel else fun(np.asarray(v)[passed]) for c, v in data.items()}
+
+
+def test(tol=1e-2):
+    # Compare against the FlowCytometryTools transforms as FCMeasurement.transform applies them (spline, auto range).
+    # tlog is compared with the exact FlowCytometryTools function, since its spline rounds off the kink at th.
+    from FlowCytometryTools.core.transforms import Transformation
+    rng = np.random.RandomState(0)
+    x = np.concatenate([rng.lognormal(7, 2, 10000) - 500, [-1000, 0, 1, 2, 262144]])
+    d = np.log10(262144)
+    for transform, args, use_spln in [('hlog', {'b': 100}, True), ('hlog', {'b': 500}, True), ('tlog', {'th': 2}, False)]:
+        expected = Transformation(transform, d=d, **args)(x, use_spln=use_spln)
+        assert np.max(np.abs(transforms[transform](x, d=d, **args) - expected)) < tol
+    gated = transform_and_gate({"GFP": x, "FSC": x[::-1]}, 'hlog', {'b': 100}, d, 4000, "FSC", "above")
+    passed = Transformation('hlog', d=d, b=100)(x[::-1], use_spln=True) >= 4000
+    assert np.array_equal(gated["GFP"], hlog(x[passed], b=100, d=d))
+    print("hlog and tlog match FlowCytometryTools within {}.".format(tol))
+
+
+def benchmark(N=10 ** 6):
+    from FlowCytometryTools.core.transforms import Transformation
+    rng = np.random.RandomState(0)
+    data = {"GFP": rng.lognormal(7, 2, N) - 500, "FSC": rng.uniform(-500, 262144, N)}
+    d = np.log10(262144)
+    start = time.time()
+    x = np.column_stack([data["GFP"], data["FSC"]])
+    transformed = Transformation('hlog', d=d, b=100)(x, use_spln=True)
+    expected = transformed[transformed[:, 1] >= 4000, 0]
+    fct_time = time.time() - start
+    hlog_table(100, d=d)
+    start = time.time()
+    gated = transform_and_gate(data, 'hlog', {'b': 100}, d, 4000, "FSC", "above")
+    numpy_time = time.time() - start
+    print("{} events: FlowCytometryTools {:.3f}s, numpy {:.3f}s ({:.1f}x), max difference {:.2e}".format(
+        N, fct_time, numpy_time, fct_time / numpy_time, np.max(np.abs(gated["GFP"] - expected))))
+
+
+if __name__ == "__main__":
+    test()
+    benchmark()
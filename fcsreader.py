@@ -0,0 +1,226 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Bree Cummins
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os, tempfile
+import numpy as np
+from FlowCytometryTools.core.transforms import Transformation
+from fcs_transforms import transform_and_gate
+
+# Lightweight reader for list mode FCS 2.0/3.0/3.1 files. Only the TEXT segment is parsed; the DATA segment is
+# memory-mapped as a structured array so each channel is a zero-copy (strided) numpy view into the file.
+
+
+class FCSData(object):
+    '''
+    The channels of an FCS file.
+
+    meta: dictionary of TEXT segment keywords (upper case) and values
+    channel_names: tuple of the $PnN names of all channels in the file
+    data: dictionary of the requested channel names mapping to 1-D numpy arrays
+    '''
+
+    def __init__(self, meta, channel_names, data):
+        self.meta = meta
+        self.channel_names = channel_names
+        self.data = data
+
+    def channel_range(self, name):
+        return float(self.meta["$P{}R".format(self.channel_names.index(name) + 1)])
+
+
+def parse_text(text, encoding="utf-8"):
+    # The first character is the delimiter. A doubled delimiter is an escaped delimiter inside a keyword or value.
+    text = text.decode(encoding, errors="replace")
+    delim = text[0]
+    body = text[1:-1] if text.endswith(delim) else text[1:]
+    words = [w.replace("\0", delim) for w in body.replace(delim * 2, "\0").split(delim)]
+    return {k.upper(): v for k, v in zip(words[0::2], words[1::2])}
+
+
+def get_dtype(meta):
+    '''
+    :param meta: dictionary of TEXT keywords
+    :return: a structured numpy dtype with one field per channel, matching one event of the DATA segment
+    '''
+    if meta.get("$MODE", "L") != "L":
+        raise ValueError("Only list mode FCS files are supported.")
+    byteord = meta["$BYTEORD"].replace(" ", "")
+    if byteord in ("1,2,3,4", "1,2", "1", "1,2,3,4,5,6,7,8"):
+        order = "<"
+    elif byteord in ("4,3,2,1", "2,1", "8,7,6,5,4,3,2,1"):
+        order = ">"
+    else:
+        raise ValueError("Byte order {} not supported.".format(byteord))
+    datatype = meta["$DATATYPE"].upper()
+    fields = []
+    for k in range(1, int(meta["$PAR"]) + 1):
+        bits = int(meta["$P{}B".format(k)])
+        if datatype == "F":
+            kind = "f4"
+        elif datatype == "D":
+            kind = "f8"
+        elif datatype == "I" and bits in (8, 16, 32, 64):
+            kind = "u{}".format(bits // 8)
+        else:
+            raise ValueError("Data type {} with {} bits not supported.".format(datatype, bits))
+        fields.append((meta["$P{}N".format(k)], order + kind))
+    return np.dtype(fields)
+
+
+def read_fcs(fname, channels=None):
+    '''
+    Read an FCS file without loading its DATA segment.
+
+    :param fname: FCS file name
+    :param channels: list of channel names ($PnN) to expose; None for all channels
+    :return: FCSData whose data values are zero-copy views into the memory-mapped file
+    '''
+    with open(fname, "rb") as f:
+        header = f.read(58)
+        version = header[:6].decode()
+        if not version.startswith("FCS"):
+            raise ValueError("{} is not an FCS file.".format(fname))
+        text_start, text_end, data_start, data_end = [int(header[k:k + 8]) for k in range(10, 42, 8)]
+        f.seek(text_start)
+        meta = parse_text(f.read(text_end - text_start + 1))
+    if not data_start and not data_end:
+        # offsets too large for the header are only given in the TEXT segment
+        data_start, data_end = int(meta["$BEGINDATA"]), int(meta["$ENDDATA"])
+    dtype = get_dtype(meta)
+    N = int(meta["$TOT"])
+    if data_end - data_start + 1 < N * dtype.itemsize:
+        raise ValueError("DATA segment of {} is shorter than $TOT events.".format(fname))
+    events = np.memmap(fname, dtype=dtype, mode="r", offset=data_start, shape=(N,))
+    channel_names = dtype.names
+    if channels is None:
+        channels = channel_names
+    missing = [c for c in channels if c not in channel_names]
+    if missing:
+        raise ValueError("Channels {} not in {}, which has channels {}.".format(missing, fname, channel_names))
+    return FCSData(meta, channel_names, {c: events[c] for c in channels})
+
+
+def write_fcs(fname, data, datatype="F", byteord="1,2,3,4"):
+    '''
+    Write a minimal FCS 3.1 file, e.g. to make synthetic test data.
+
+    :param fname: output file name
+    :param data: dictionary of channel names mapping to equal length 1-D arrays
+    :param datatype: "F", "D" or "I" (32 bit integers)
+    :param byteord: "1,2,3,4" (little endian) or "4,3,2,1" (big endian)
+    '''
+    names = list(data)
+    bits = {"F": 32, "D": 64, "I": 32}[datatype]
+    meta = {"$BYTEORD": byteord, "$DATATYPE": datatype, "$MODE": "L", "$NEXTDATA": "0", "$PAR": str(len(names)),
+            "$TOT": str(len(data[names[0]])), "$BEGINANALYSIS": "0", "$ENDANALYSIS": "0", "$BEGINSTEXT": "0",
+            "$ENDSTEXT": "0"}
+    for k, name in enumerate(names):
+        meta.update({"$P{}N".format(k + 1): name, "$P{}B".format(k + 1): str(bits), "$P{}E".format(k + 1): "0,0",
+                     "$P{}R".format(k + 1): "262144"})
+    dtype = get_dtype(meta)
+    events = np.zeros(len(data[names[0]]), dtype=dtype)
+    for name in names:
+        events[name] = data[name]
+    raw = events.tobytes()
+    # the data offsets depend on the length of the TEXT segment, so fix their width
+    meta["$BEGINDATA"] = meta["$ENDDATA"] = "0" * 20
+    text_length = len(("/" + "".join("{}/{}/".format(k, v.replace("/", "//")) for k, v in meta.items())).encode())
+    data_start = 58 + text_length
+    meta["$BEGINDATA"] = str(data_start).zfill(20)
+    meta["$ENDDATA"] = str(data_start + len(raw) - 1).zfill(20)
+    text = ("/" + "".join("{}/{}/".format(k, v.replace("/", "//")) for k, v in meta.items())).encode()
+    offsets = [58, 58 + len(text) - 1, data_start, data_start + len(raw) - 1]
+    if offsets[3] > 99999999:
+        offsets[2] = offsets[3] = 0
+    with open(fname, "wb") as f:
+        f.write(b"FCS3.1    " + "".join(str(o).rjust(8) for o in offsets + [0, 0]).encode())
+        f.write(text)
+        f.write(raw)
+
+
+def transform_data(fname, transform, transform_args, channels, threshold, channel, region, engine="fct"):
+    '''
+    Same as transform_data in process_fcs_files and automated_pipeline_scoring, but reads only the requested channels
+    with read_fcs instead of building an FCMeasurement. The transform uses the FlowCytometryTools transformation
+    exactly as FCMeasurement.transform does (range from $PnR, spline over the data range), and the threshold gate
+    passes values >= threshold for region 'above' as ThresholdGate does.
+    With engine="numpy", the transform and gate are done in one pass by fcs_transforms.transform_and_gate instead.
+
+    :return: FCSData with the transformed and gated channels
+    '''
+    if transform is not None and transform not in transform_args:
+        raise ValueError("Transform {} not recognized.".format(transform))
+    names = [c for _, c in channels.items()]
+    sample = read_fcs(fname, names)
+    if transform is not None:
+        ranges = [sample.channel_range(c) for c in names]
+        if not np.allclose(ranges, ranges[0]):
+            raise ValueError("Channels {} of {} do not have the same data range.".format(names, fname))
+    if engine == "numpy":
+        sample.data = transform_and_gate(sample.data, transform, transform_args.get(transform),
+                                         np.log10(ranges[0]) if transform else None,
+                                         threshold, channels[channel] if threshold else None, region)
+        return sample
+    elif engine != "fct":
+        raise ValueError("Engine {} not recognized.".format(engine))
+    if transform is not None:
+        transformer = Transformation(transform, d=np.log10(ranges[0]), **transform_args[transform])
+        values = transformer(np.column_stack([sample.data[c] for c in names]), use_spln=True)
+        sample.data = {c: values[:, k] for k, c in enumerate(names)}
+    if threshold:
+        passed = sample.data[channels[channel]] >= threshold
+        if region == "below":
+            passed = ~passed
+        sample.data = {c: v[passed] for c, v in sample.data.items()}
+    return sample
+
+
+def test():
+    tmpdir = tempfile.mkdtemp()
+    rng = np.random.RandomState(0)
+    data = {"FSC-A": rng.uniform(0, 20000, 1000), "BL1-A": rng.lognormal(7, 1, 1000), "RL1": rng.rand(1000)}
+    for datatype, byteord, dtype in [("F", "1,2,3,4", np.float32), ("D", "4,3,2,1", np.float64),
+                                     ("I", "1,2,3,4", np.uint32)]:
+        fname = os.path.join(tmpdir, "test_fcsreader_{}.fcs".format(datatype))
+        write_fcs(fname, data, datatype, byteord)
+        sample = read_fcs(fname, ["BL1-A", "FSC-A"])
+        assert sample.channel_names == ("FSC-A", "BL1-A", "RL1")
+        assert sorted(sample.data) == ["BL1-A", "FSC-A"]
+        for c, v in sample.data.items():
+            assert isinstance(v.base, np.memmap) or isinstance(v, np.memmap)
+            assert np.array_equal(v, data[c].astype(dtype))
+        del sample
+        for engine in ["fct", "numpy"]:
+            try:
+                transform_data(fname, "nolog", {}, {"FSC": "FSC-A"}, None, "FSC", "above", engine)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("unknown transform accepted by engine {}".format(engine))
+        os.remove(fname)
+    os.rmdir(tmpdir)
+    print("read_fcs reads back synthetic FCS files.")
+
+
+if __name__ == "__main__":
+    test()
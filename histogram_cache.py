@@ -0,0 +1,78 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Bree Cummins
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import hashlib, json, os, tempfile
+import numpy as np
+
+# On-disk cache of per-file histograms. The key of a histogram is a hash of the FCS file contents together with every
+# processing parameter that affects it, so changing the transform, gate or bins misses the cache automatically.
+# Each histogram is stored as a small .npy file named by its key.
+
+
+def file_hash(fname, blocksize=2**20):
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def histogram_key(fname, transform, transform_args, channels, threshold, channel, region, bin_endpoints, backend):
+    '''
+    :param fname: FCS file name
+    :param transform: name of the transform ('hlog', 'tlog' or None)
+    :param transform_args: dictionary of the transform parameters (e.g. {'b': 100})
+    :param channels: dictionary of channel names used by transform_data
+    :param threshold: gate threshold
+    :param channel: gated channel
+    :param region: gate region
+    :param bin_endpoints: histogram bin endpoints
+    :param backend: transform_data backend ("fct", "native" or "numpy"), since the "numpy" transforms are interpolated
+    :return: hex string identifying the histogram
+    '''
+    params = {"file": file_hash(fname), "transform": transform, "transform_args": transform_args,
+              "channels": channels, "threshold": threshold, "channel": channel, "region": region,
+              "bin_endpoints": [repr(float(e)) for e in bin_endpoints], "backend": backend}
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def _path(cachedir, key):
+    return os.path.join(os.path.expanduser(cachedir), key[:2], key + ".npy")
+
+
+def load_histogram(cachedir, key):
+    # returns None on a cache miss
+    try:
+        return np.load(_path(cachedir, key))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_histogram(cachedir, key, hist):
+    path = _path(cachedir, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first so concurrent workers never see a partial histogram
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        np.save(f, np.asarray(hist, dtype=np.int64))
+    os.replace(tmp, path)
@@ -0,0 +1,138 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Bree Cummins
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import ast, os, tempfile
+import numpy as np
+import pandas as pd
+from synthetic_circuit_performance import getcircuit
+
+# Columnar index of a manifest in the format of transcriptic_april_fcsfiles_dan.csv. The csv is parsed once into a
+# dictionary of numpy arrays, one entry per row of the csv, with the fields the pipeline needs already derived:
+#
+#   row          position of the row in the csv
+#   id, plan     copied from the csv
+#   bead         True for bead control rows
+#   circuit      getcircuit() of the gate, "" if there is none
+#   input_state  input as a bit string (e.g. "10"), "" for wild type
+#   media        short media name (e.g. "culture_media_4")
+#   od, rep      optical density and replicate as floats
+#   path         local path of the first FCS file under prefix
+#   experiment   the experiment directory of path
+#
+# The arrays are saved next to the csv as a sidecar .npz file, which is reused while the csv and prefix are unchanged.
+
+columns = ["row", "id", "plan", "bead", "circuit", "input_state", "media", "od", "rep", "path", "experiment"]
+
+
+def sidecar_name(ingest_file):
+    return ingest_file + ".manifest.npz"
+
+
+def _source_stamp(ingest_file, prefix):
+    st = os.stat(ingest_file)
+    return np.array([str(st.st_size), str(st.st_mtime_ns), os.path.expanduser(prefix)])
+
+
+def _input_state(s):
+    try:
+        return "".join([str(b) for b in ast.literal_eval(s)])
+    except:
+        # wild type has no input state
+        return ""
+
+
+def parse_manifest(ingest_file="transcriptic_april_fcsfiles_dan.csv", prefix="~/sd2e-community"):
+    '''
+    Parse a manifest csv into columns.
+
+    :param ingest_file: csv in the format of transcriptic_april_fcsfiles_dan.csv
+    :param prefix: local directory that replaces the agave://data-sd2e-community part of the file locations
+    :return: dictionary of numpy arrays keyed by the names in columns
+    '''
+    df = pd.read_csv(open(ingest_file))
+    root = os.path.expanduser(prefix)
+    paths = [os.path.join(root, "/".join(ast.literal_eval(f)[0].split('/')[3:])) for f in df["fcs_files"]]
+    return {
+        "row": np.arange(len(df)),
+        "id": np.array([str(i) for i in df["id"]], dtype="U"),
+        "plan": np.array([str(p) for p in df["plan"]], dtype="U"),
+        "bead": np.asarray(df["bead"].notnull(), dtype=bool),
+        "circuit": np.array([(getcircuit(g) or "") if isinstance(g, str) else "" for g in df["gate"]], dtype="U"),
+        "input_state": np.array([_input_state(s) for s in df["input"]], dtype="U"),
+        "media": np.array([m.split('/')[-2] if isinstance(m, str) else "" for m in df["media"]], dtype="U"),
+        "od": np.asarray(df["od"], dtype=float),
+        "rep": np.asarray(df["replicate"], dtype=float),
+        "path": np.array(paths, dtype="U"),
+        "experiment": np.array([p.split('/')[-4] for p in paths], dtype="U"),
+    }
+
+
+def load_manifest(ingest_file="transcriptic_april_fcsfiles_dan.csv", prefix="~/sd2e-community", sidecar=True):
+    '''
+    Return the columns of a manifest, from the sidecar file when it is up to date and otherwise by parsing the csv
+    (and then rewriting the sidecar).
+
+    :param ingest_file: csv in the format of transcriptic_april_fcsfiles_dan.csv
+    :param prefix: local directory of the FCS files (see parse_manifest)
+    :param sidecar: if False, always parse the csv and do not write the sidecar
+    :return: dictionary of numpy arrays keyed by the names in columns
+    '''
+    stamp = _source_stamp(ingest_file, prefix)
+    fname = sidecar_name(ingest_file)
+    if sidecar and os.path.exists(fname):
+        with np.load(fname) as f:
+            if np.array_equal(f["_source"], stamp):
+                return {c: f[c] for c in columns}
+    manifest = parse_manifest(ingest_file, prefix)
+    if sidecar:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, _source=stamp, **manifest)
+            os.replace(tmp, fname)
+        except:
+            os.remove(tmp)
+            raise
+    return manifest
+
+
+def select(manifest, **filters):
+    '''
+    Find the rows of a manifest that pass all of the filters, e.g.
+    select(manifest, bead=False, circuit=["AND", "OR"], input_state=lambda s: s != "").
+
+    :param manifest: output of load_manifest
+    :param filters: column name = a value, a list/tuple/set of allowed values, or a function from the column array to
+    a Boolean array
+    :return: numpy array of the positions of the selected rows, in manifest order
+    '''
+    mask = np.ones(len(manifest["row"]), dtype=bool)
+    for name, value in filters.items():
+        col = manifest[name]
+        if callable(value):
+            mask &= np.asarray(value(col), dtype=bool)
+        elif isinstance(value, (list, tuple, set)):
+            mask &= np.isin(col, list(value))
+        else:
+            mask &= col == value
+    return np.flatnonzero(mask)
@@ -0,0 +1,91 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Bree Cummins
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import json
+import numpy as np
+
+# A binary params file is the magic string, the length of a JSON header as a little-endian uint64, the header, and
+# then the sorted parameter index arrays of every key back to back. The header holds the dtype and the
+# (offset, count) of each key, so a reader can memory-map the file and slice any list without parsing text.
+MAGIC = b"YGPARAMS"
+
+
+def save_params(params, fname, num_params=None):
+    '''
+    Save lists of parameter indices in the binary params format.
+
+    :param params: dictionary of lists of parameter indices, or a list of lists (keyed by position, as in the json
+    files written by json.dump)
+    :param fname: output file name
+    :param num_params: size of the parameter graph; used to choose uint32 over uint64 when it fits
+    :return: fname
+    '''
+    if not isinstance(params, dict):
+        params = dict(enumerate(params))
+    arrays = {str(k): np.sort(np.asarray(v, dtype=np.uint64)) for k, v in params.items()}
+    largest = max([int(a[-1]) for a in arrays.values() if len(a)] + [num_params or 0])
+    dtype = np.dtype("<u4") if largest < 2**32 else np.dtype("<u8")
+    keys = {}
+    offset = 0
+    for k, a in arrays.items():
+        keys[k] = [offset, len(a)]
+        offset += len(a)
+    header = json.dumps({"dtype": dtype.str, "num_params": num_params, "keys": keys}).encode()
+    # pad the header so the data starts on an 8 byte boundary
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % 8)
+    with open(fname, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).astype("<u8").tobytes())
+        f.write(header)
+        for a in arrays.values():
+            f.write(a.astype(dtype).tobytes())
+    return fname
+
+
+def is_binary_params(fname):
+    with open(fname, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_params(fname, mmap=True):
+    '''
+    Load a params file written either by save_params or by json.dump.
+
+    :param fname: file name
+    :param mmap: True or False. Memory-map a binary file instead of reading it into memory.
+    :return: dictionary of string keys mapping to arrays of parameter indices (views into the memory-mapped file) for
+    binary files, or whatever json.load returns for json files
+    '''
+    if not is_binary_params(fname):
+        return json.load(open(fname))
+    with open(fname, "rb") as f:
+        f.seek(len(MAGIC))
+        header_length = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        header = json.loads(f.read(header_length).decode())
+    start = len(MAGIC) + 8 + header_length
+    total = sum(count for _, count in header["keys"].values())
+    if mmap and total:
+        data = np.memmap(fname, dtype=header["dtype"], mode="r", offset=start, shape=(total,))
+    else:
+        data = np.fromfile(fname, dtype=header["dtype"], offset=start)
+    return {k: data[offset:offset + count] for k, (offset, count) in header["keys"].items()}
@@ -0,0 +1,156 @@
+# The MIT License (MIT)
+#
+# Copyright (c) 2018 Bree Cummins
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import FlowCytometryTools as FCT
+import multiprocessing
+import numpy as np
+from rank_order_truth_tables import bootstrap_groups, bootstrap_groups_adaptive, keyed_seeds, get_input_states
+from synthetic_circuit_performance import desired_truth_tables
+from histogram_cache import histogram_key, load_histogram, save_histogram
+import fcsreader
+
+# Ingest and scoring helpers shared by process_fcs_files and automated_pipeline_scoring: loading, transforming and
+# gating FCS files on a process pool, reducing them to GFP histograms, and bootstrap scoring of pooled groups.
+
+
+# the 2^k input states of a k-input gate; desired_truth_tables are for k = 2
+input_states = get_input_states(2)
+
+# parameters of the FlowCytometryTools transforms used in transform_data
+transform_args = {'hlog': {'b': 100}, 'tlog': {'th': 2}}
+
+
+def transform_data(fname,transform,channels,threshold,channel,region,backend="fct"):
+    #Transform and gate using flowcytometrytools
+    #backend="native" reads only the needed channels with fcsreader; the channels are then numpy arrays, not a DataFrame
+    #backend="numpy" also replaces the FlowCytometryTools transform and gate with fcs_transforms
+    if backend == "native":
+        return fcsreader.transform_data(fname, transform, transform_args, channels, threshold, channel, region)
+    elif backend == "numpy":
+        return fcsreader.transform_data(fname, transform, transform_args, channels, threshold, channel, region, "numpy")
+    elif backend != "fct":
+        raise ValueError("Backend {} not recognized.".format(backend))
+    sample = FCT.FCMeasurement(ID="temp", datafile=fname)
+    if transform in transform_args:
+        # see FlowCytometryTools documentation
+        sample = sample.transform(transform, channels=[c for _, c in channels.items()], **transform_args[transform])
+    elif transform is not None:
+        raise ValueError("Transform {} not recognized.".format(transform))
+    if threshold:
+        try:
+            gate = FCT.ThresholdGate(threshold, [channels[channel]], region=region)
+            sample = sample.gate(gate)
+        except:
+            print(fname)
+            print(sample.channel_names)
+            raise
+    return sample
+
+
+def get_log_values(values, out=None):
+    # log10 of the positive values and -1 everywhere else. Pass out=values to transform a float channel buffer in place.
+    values = np.asarray(values, dtype=float)
+    if out is None:
+        out = np.empty_like(values)
+    positive = values > 0
+    np.log10(values, out=out, where=positive)
+    out[~positive] = -1
+    return out
+
+
+def bin_data(pts, bin_endpoints):
+    # The bin of a point is the number of endpoints strictly below it, so a point equal to an endpoint is counted in
+    # the bin that ends there and points above the last endpoint go in the overflow bin.
+    inds = np.searchsorted(np.sort(np.asarray(bin_endpoints, dtype=float)), np.asarray(pts, dtype=float), side='left')
+    return np.bincount(inds, minlength=len(bin_endpoints) + 1).tolist()
+
+
+def log_bin_data(values, bin_endpoints):
+    # Same as bin_data(get_log_values(values), bin_endpoints) without computing any log values: the endpoints are
+    # moved to the linear scale instead, so points within rounding error of an endpoint may land in a neighboring bin.
+    endpoints = np.sort(np.asarray(bin_endpoints, dtype=float))
+    values = np.asarray(values)
+    inds = np.searchsorted(10 ** endpoints, values, side='left')
+    inds[~(values > 0)] = np.searchsorted(endpoints, -1, side='left')
+    return np.bincount(inds, minlength=len(endpoints) + 1).tolist()
+
+
+def map_files(func, jobs, workers=1):
+    # Apply func to each job and yield the results in the order of jobs, on a process pool if workers > 1.
+    if workers == 1:
+        for job in jobs:
+            yield func(job)
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            for result in pool.imap(func, jobs, chunksize=4):
+                yield result
+
+
+def _transform_file(args):
+    return transform_data(*args)
+
+
+def _hist_file(args):
+    # Load, transform and gate one file, then keep only its GFP histogram so the sample can be freed.
+    # If a cache directory is given, the histogram is read from or saved to the cache (see histogram_cache).
+    fname, transform, channels, threshold, channel, region, backend, bin_endpoints, cachedir = args
+    if cachedir:
+        key = histogram_key(fname, transform, transform_args.get(transform), channels, threshold, channel, region,
+                            bin_endpoints, backend)
+        hist = load_histogram(cachedir, key)
+        if hist is not None:
+            return hist
+    sample = transform_data(fname, transform, channels, threshold, channel, region, backend)
+    hist = np.asarray(bin_data(get_log_values(np.asarray(sample.data[channels["GFP"]])), bin_endpoints))
+    if cachedir:
+        save_histogram(cachedir, key, hist)
+    return hist
+
+
+def get_desired_truth_table(md):
+    for m in md:
+        if m[0] == "circuit":
+            return desired_truth_tables[m[1]]
+
+
+def score_groups(pools, bin_centers, num_choices, seed, workers=1, tol=None, median_tol=None):
+    # Score num_choices random circuits for each of pools, a dictionary keyed by group of either pooled histograms
+    # keyed by input state, or a single list of histograms from which every input state is drawn (a null model).
+    # The draws are scored with bootstrap_groups, or with bootstrap_groups_adaptive if a tolerance is given. The stream
+    # of each group is derived from seed and the group key (see keyed_seeds), so its scores do not depend on which
+    # other groups are scored.
+    seeds = keyed_seeds(seed, list(pools))
+    groups = []
+    for md, ip in pools.items():
+        if isinstance(ip, dict):
+            groups.append(([h for k in input_states for h in ip[k]], [len(ip[k]) for k in input_states],
+                           get_desired_truth_table(md)))
+        else:
+            groups.append((ip, None, get_desired_truth_table(md)))
+    if tol is None:
+        results = bootstrap_groups(groups, input_states, bin_centers, num_choices, seeds, workers)
+    else:
+        results = bootstrap_groups_adaptive(groups, input_states, bin_centers, num_choices, seeds, tol, median_tol,
+                                            workers=workers)
+    return {md: {'truthtable_incorrect': separation[~correct].tolist(), 'truthtable_correct': separation[correct].tolist()}
+            for md, (correct, separation) in zip(pools, results)}
@@ -21,17 +21,20 @@
 # SOFTWARE.
 
 
-import FlowCytometryTools as FCT
 import json, os
-from rank_order_truth_tables import rank_noncst_tables
+from rank_order_truth_tables import rank_noncst_tables, get_input_states
 from synthetic_circuit_performance import getcircuit
+# transform_data is imported so that process_fcs_files.transform_data keeps working
+from pipeline_common import transform_data, map_files, _transform_file, _hist_file, get_log_values, bin_data, \
+    log_bin_data, get_desired_truth_table, score_groups
 import numpy as np
 import itertools
 import pandas as pd
 import ast, random
 from pprint import pprint
 
-input_states = ["00", "01", "10", "11"]
+# the 2^k input states of a k-input gate; desired_truth_tables below are for k = 2
+input_states = get_input_states(2)
 
 desired_truth_tables = {
     "NOR" : {'00' : 1, '01' : 0, '10' : 0, '11' : 0},
@@ -57,24 +60,10 @@ def get_channels(lab_name):
     return {"GFP": GFP, "Sytox": Sytox, "FSC": forward_scatter}
 
 
-def transform_data(fname,transform,channels,threshold,channel,region):
-    sample = FCT.FCMeasurement(ID="temp", datafile=fname)
-    if transform == 'hlog':
-        # see FlowCytometryTools documentation
-        sample = sample.transform(transform, channels=[c for _, c in channels.items()], b=100)
-    elif transform == 'tlog':
-        sample = sample.transform(transform, channels=[c for _, c in channels.items()], th=2)
-    elif transform is not None:
-        raise ValueError("Transform {} not recognized.".format(transform))
-    if threshold:
-        gate = FCT.ThresholdGate(threshold, [channels[channel]], region=region)
-        sample = sample.gate(gate)
-    return sample
-
-def get_data(circuit,ingest_file="matches_biofab_all_circuits_all_media.json",transform=None,threshold=None,channel=None,region=None):
+def get_files(circuit,ingest_file="matches_biofab_all_circuits_all_media.json"):
+    # Returns (experiment, fname, channels, metadata) for each file of the circuit in ingest_file.
     matches = json.load(open(ingest_file))
-    data = {}
-    count = 0
+    files = []
     for m in matches:
         try:
             c = getcircuit(m['strain_circuit'])
@@ -95,35 +84,27 @@ def get_data(circuit,ingest_file="matches_biofab_all_circuits_all_media.json",tr
             except:
                 od = None
             metadata = {'media': media, 'circuit': circuit, 'od': od, 'input_state': input_state, 'rep': rep}
-            sample = transform_data(fname, transform, channels, threshold,channel,region)
             d = fname.split('/')[-2]
-            if d in data:
-                data[d].append((sample, channels, metadata))
-            else:
-                data[d] = [(sample, channels, metadata)]
-            count += 1
-            if not count % 50:
-                print("{} files found.".format(count))
-    print("{} files in total.".format(count))
-    return data
+            files.append((d, fname, channels, metadata))
+    return files
 
 
-def get_log_values(values):
-    log_vals = []
-    for v in values:
-        if v > 0:
-            log_vals.append(np.log10(v))
+def get_data(circuit,ingest_file="matches_biofab_all_circuits_all_media.json",transform=None,threshold=None,channel=None,region=None,workers=1,backend="fct"):
+    # With workers > 1 the files are loaded, transformed and gated on a process pool; the result is the same.
+    files = get_files(circuit,ingest_file)
+    jobs = [(fname, transform, channels, threshold, channel, region, backend) for _, fname, channels, _ in files]
+    data = {}
+    count = 0
+    for (d, fname, channels, metadata), sample in zip(files, map_files(_transform_file, jobs, workers)):
+        if d in data:
+            data[d].append((sample, channels, metadata))
         else:
-            log_vals.append(-1)
-    return np.asarray(log_vals)
-
-
-def bin_data(pts, bin_endpoints):
-    hist = [0] * (len(bin_endpoints) + 1)
-    for p in list(pts):
-        ind = sorted(list(bin_endpoints) + [p]).index(p)                
-        hist[ind] += 1
-    return hist
+            data[d] = [(sample, channels, metadata)]
+        count += 1
+        if not count % 50:
+            print("{}/{} files loaded.".format(count,len(files)))
+    print("{} files in total.".format(count))
+    return data
 
 
 def get_bin_centers(bin_endpoints):
@@ -140,15 +121,54 @@ def sort_strains_into_histograms(data, bin_endpoints, media=None, od=None):
                 md = metadata.copy()
                 md.pop("input_state")
                 md = tuple(md.items())
-                pts = get_log_values(sample.data[channels["GFP"]].values.transpose())
+                pts = get_log_values(np.asarray(sample.data[channels["GFP"]]))
                 hist = bin_data(pts, bin_endpoints)
                 if md not in circuits:
-                    circuits[md] = {"00": [], "01": [], "10": [], "11": []}
+                    circuits[md] = {k: [] for k in input_states}
                 circuits[md][ip].append(np.asarray(hist))
     return circuits
 
 
-def get_results(circuits, bin_endpoints, num_choices=25):
+def get_hists(circuit, bin_endpoints, ingest_file="matches_biofab_all_circuits_all_media.json", transform=None, threshold=None, channel=None, region=None, media=None, od=None, workers=1, backend="fct"):
+    '''
+    Streaming version of sort_strains_into_histograms(get_data(...), bin_endpoints, media, od). Each file is reduced to
+    its GFP histogram as soon as it is loaded, so the full samples are never held in memory together.
+
+    :return: the same dictionary as sort_strains_into_histograms
+    '''
+    files = [f for f in get_files(circuit,ingest_file)
+             if (not media or f[3]["media"] == media) and (not od or f[3]['od'] == od)]
+    jobs = [(fname, transform, channels, threshold, channel, region, backend, bin_endpoints, None)
+            for _, fname, channels, _ in files]
+    experiments = {}
+    count = 0
+    for (d, fname, channels, metadata), hist in zip(files, map_files(_hist_file, jobs, workers)):
+        experiments.setdefault(d, []).append((hist, metadata))
+        count += 1
+        if not count % 50:
+            print("{}/{} files loaded.".format(count,len(files)))
+    print("{} files in total.".format(count))
+    circuits = {}
+    for d, hists in experiments.items():
+        for hist, metadata in hists:
+            md = metadata.copy()
+            ip = md.pop("input_state")
+            md = tuple(md.items())
+            if md not in circuits:
+                circuits[md] = {k: [] for k in input_states}
+            circuits[md][ip].append(hist)
+    return circuits
+
+
+def get_results(circuits, bin_endpoints, num_choices=25, batched=False, seed=None, workers=1, tol=None,
+                median_tol=None):
+    # With batched=True or a seed (int, numpy SeedSequence or Generator), each group draws from its own numpy stream
+    # derived from seed and the group key, and all draws are scored with bootstrap_groups on workers processes. The
+    # result is reproducible, the same for any number of workers and does not depend on the other groups. Otherwise the
+    # draws come from the random module and workers is not used.
+    # With a tolerance tol, num_choices is the average budget per group and each group stops drawing once its fraction
+    # correct is known to within tol and its median separation to within median_tol, which is in units of the
+    # separation and defaults to tol (see bootstrap_groups_adaptive).
     new_circuits = {}
     for metadata, vals in circuits.items():
         md = []
@@ -162,16 +182,15 @@ def get_results(circuits, bin_endpoints, num_choices=25):
             temp = dict(new_circuits[md])
             new_circuits[md] = {k: temp.get(k) + vals.get(k) for k in vals.keys()}
     bin_centers = np.asarray(get_bin_centers(bin_endpoints))
+    if batched or seed is not None or tol is not None:
+        return score_groups(new_circuits, bin_centers, num_choices, seed, workers, tol, median_tol)
     all_scores = {md: {'truthtable_incorrect': [], 'truthtable_correct': []} for md in new_circuits}
     for md, ip in new_circuits.items():
-        for m in md:
-            if m[0] == "circuit":
-                desiredtt = desired_truth_tables[m[1]]
-                break
+        desiredtt = get_desired_truth_table(md)
         truthtable_incorrect = []
         truthtable_correct = []
         for _ in range(num_choices):
-            choice = [np.asarray(random.choice(ip[input_states[k]])) for k in range(4)]
+            choice = [np.asarray(random.choice(ip[input_states[k]])) for k in range(len(input_states))]
             d = dict(zip(input_states, choice))
             scores = rank_noncst_tables(d, bin_centers)
             if scores[0][1] == desiredtt:
@@ -183,7 +202,9 @@ def get_results(circuits, bin_endpoints, num_choices=25):
     return all_scores
 
 
-def build_null_model(circuits, bin_endpoints, num_choices=50):
+def build_null_model(circuits, bin_endpoints, num_choices=50, batched=False, seed=None, workers=1, tol=None,
+                     median_tol=None):
+    # batched, seed, workers, tol and median_tol as in get_results
     random_circuits = {}
     for metadata, vals in circuits.items():
         md = []
@@ -196,17 +217,16 @@ def build_null_model(circuits, bin_endpoints, num_choices=50):
             random_circuits[md] = all_inputs
         else:
             random_circuits[md].extend(all_inputs)
-    bin_centers = get_bin_centers(bin_endpoints)
+    bin_centers = np.asarray(get_bin_centers(bin_endpoints))
+    if batched or seed is not None or tol is not None:
+        return score_groups(random_circuits, bin_centers, num_choices, seed, workers, tol, median_tol)
     all_scores = {md: {'truthtable_incorrect': [], 'truthtable_correct': []} for md in random_circuits}
     for md, ip in random_circuits.items():
-        for m in md:
-            if m[0] == "circuit":
-                desiredtt = desired_truth_tables[m[1]]
-                break
+        desiredtt = get_desired_truth_table(md)
         truthtable_incorrect = []
         truthtable_correct = []
         for _ in range(num_choices):
-            choice = [np.asarray(random.choice(ip)) for _ in range(4)]
+            choice = [np.asarray(random.choice(ip)) for _ in input_states]
             d = dict(zip(input_states, choice))
             scores = rank_noncst_tables(d, bin_centers)
             if scores[0][1] == desiredtt:
@@ -216,3 +236,46 @@ def build_null_model(circuits, bin_endpoints, num_choices=50):
         all_scores[md]['truthtable_incorrect'].extend(truthtable_incorrect)
         all_scores[md]['truthtable_correct'].extend(truthtable_correct)
     return all_scores
+
+
+def test_bin_data():
+    # compare bin_data against the original per point implementation
+    def bin_data_loop(pts, bin_endpoints):
+        hist = [0] * (len(bin_endpoints) + 1)
+        for p in list(pts):
+            ind = sorted(list(bin_endpoints) + [p]).index(p)
+            hist[ind] += 1
+        return hist
+    bin_endpoints = [np.log10(r) for r in range(250, 10250, 250)]
+    rng = np.random.RandomState(0)
+    pts = np.concatenate([rng.uniform(1, 5, 5000), bin_endpoints, [-1, -1, 0, bin_endpoints[-1] + 1]])
+    assert bin_data(pts, bin_endpoints) == bin_data_loop(pts, bin_endpoints)
+    assert bin_data([], bin_endpoints) == [0] * (len(bin_endpoints) + 1)
+    assert bin_data([2, 0.5, 3.5, 2], [1, 2, 3]) == bin_data_loop([2, 0.5, 3.5, 2], [1, 2, 3]) == [1, 2, 0, 1]
+    print("bin_data matches the per point implementation.")
+
+
+def test_log_values():
+    # compare get_log_values and log_bin_data against the original per point implementation
+    def get_log_values_loop(values):
+        log_vals = []
+        for v in values:
+            if v > 0:
+                log_vals.append(np.log10(v))
+            else:
+                log_vals.append(-1)
+        return np.asarray(log_vals)
+    bin_endpoints = [np.log10(r) for r in range(250, 10250, 250)]
+    rng = np.random.RandomState(0)
+    values = np.concatenate([rng.uniform(-1000, 20000, 5000), [0, -0.0, 1, 10]])
+    expected = get_log_values_loop(values)
+    assert np.array_equal(get_log_values(values), expected)
+    buffer = values.copy()
+    assert get_log_values(buffer, out=buffer) is buffer and np.array_equal(buffer, expected)
+    assert log_bin_data(values, bin_endpoints) == bin_data(expected, bin_endpoints)
+    print("get_log_values and log_bin_data match the per point implementation.")
+
+
+if __name__ == "__main__":
+    test_bin_data()
+    test_log_values()
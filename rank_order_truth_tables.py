@@ -20,7 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import pyemd, itertools
+import pyemd, itertools, heapq, multiprocessing, hashlib
 import numpy as np
 from pprint import pprint
 
@@ -33,7 +33,8 @@ def make_bin_dist(bin_vals):
     of histograms. For yeast gates, these values are generally going to be exponents of fluorescence.
     :return: a numpy array of the pairwise distances between points
     '''
-    return np.array([[np.abs(m - n) for m in bin_vals] for n in bin_vals])
+    bin_vals = np.asarray(bin_vals, dtype=float)
+    return np.abs(np.subtract.outer(bin_vals, bin_vals))
 
 
 def emdist(h1, h2, bin_vals):
@@ -48,6 +49,67 @@ def emdist(h1, h2, bin_vals):
     return pyemd.emd(np.asarray(h1)/float(sum(h1)), np.asarray(h2)/float(sum(h2)), make_bin_dist(bin_vals))
 
 
+class EMDScorer(object):
+    '''
+    Earth mover's distances between histograms that all share the same bins. The bin distance matrix is made once at
+    construction instead of once per distance.
+
+    With method="cdf" the closed form for 1-D histograms is used: the EMD is the L1 distance between the cumulative
+    distributions weighted by the bin spacing. This requires increasing bin_vals and agrees with pyemd up to round-off.
+    With method="pyemd" each distance is a call to pyemd.emd with the stored distance matrix.
+    '''
+
+    def __init__(self, bin_vals, method="cdf"):
+        '''
+        :param bin_vals: representative points in the bins defining the histograms to be compared
+        :param method: "cdf" or "pyemd"
+        '''
+        self.bin_vals = np.asarray(bin_vals, dtype=float)
+        if method not in ("cdf", "pyemd"):
+            raise ValueError("EMD method {} not recognized.".format(method))
+        if method == "cdf" and np.any(np.diff(self.bin_vals) <= 0):
+            raise ValueError("The closed form EMD requires strictly increasing bin values.")
+        self.method = method
+        self.bin_dist = make_bin_dist(self.bin_vals)
+        self.spacing = np.diff(self.bin_vals)
+
+    def normalize(self, hists):
+        '''
+        :param hists: a sequence of K histograms or a K x (number of bins) array
+        :return: K x (number of bins) float array with each row summing to 1
+        '''
+        hists = np.atleast_2d(np.asarray(hists, dtype=float))
+        return hists / hists.sum(axis=1, keepdims=True)
+
+    def pairwise(self, hists):
+        '''
+        Calculate the earth mover's distance between every pair of histograms.
+
+        :param hists: a sequence of K histograms or a K x (number of bins) array
+        :return: symmetric K x K numpy array of distances with zero diagonal
+        '''
+        hists = self.normalize(hists)
+        K = hists.shape[0]
+        dists = np.zeros((K, K))
+        if self.method == "cdf":
+            cdfs = np.cumsum(hists, axis=1)[:, :-1]
+            for i in range(K - 1):
+                dists[i, i+1:] = np.abs(cdfs[i+1:] - cdfs[i]).dot(self.spacing)
+        else:
+            for i in range(K - 1):
+                for j in range(i + 1, K):
+                    dists[i, j] = pyemd.emd(hists[i], hists[j], self.bin_dist)
+        return dists + dists.T
+
+    def emdist(self, h1, h2):
+        '''
+        :param h1: a 1-D numpy array representing a histogram with the scorer's bin values
+        :param h2: a 1-D numpy array representing a histogram with the scorer's bin values
+        :return: a scalar value that is the earth mover's distance between normalized h1 and h2
+        '''
+        return self.pairwise([h1, h2])[0, 1]
+
+
 def similarity(dist):
     '''
     Transform a distance into a similarity score.
@@ -58,20 +120,23 @@ def similarity(dist):
     return np.exp(-dist**2 / 2)
 
 
-def make_graph(data,bin_vals):
+def make_graph(data,bin_vals,scorer=None):
     '''
     Make a dictionary of pairwise similarity values that represents a weighted graph.
 
     :param data: a length 2^k dictionary mapping an input state to a 1-D numpy array histogram, all defined by the same bin values
     :param bin_vals: representative points in the bins defining the histograms in data
+    :param scorer: an EMDScorer for bin_vals; default is EMDScorer(bin_vals, "pyemd"), which reproduces emdist()
     :return: dictionary of real values between 0 and 1 keyed by pairs of input states, with no repeated pairs (upper triangular part of similarity matrix, or similarly, the list of weighted edges in an undirected graph)
     '''
+    if scorer is None:
+        scorer = EMDScorer(bin_vals, "pyemd")
     inputstates = [k for k in data]
+    dists = scorer.pairwise([data[i] for i in inputstates])
     graph = {}
     for t,i in enumerate(inputstates[:-1]):
-        for j in inputstates[t+1:]:
-            v = emdist(data[i],data[j],bin_vals)
-            graph.update( {(i,j) : similarity(emdist(data[i],data[j],bin_vals))} )
+        for u,j in enumerate(inputstates[t+1:]):
+            graph.update( {(i,j) : similarity(dists[t,t+1+u])} )
     return graph
 
 
@@ -172,15 +237,16 @@ def make_truth_table(partition,inputstates,b):
     return dict([(i,b) if i in partition else (i, (b + 1) % 2) for i in inputstates])
 
 
-def rank_noncst_tables(data,bin_vals):
+def rank_noncst_tables(data,bin_vals,scorer=None):
     '''
     Return scored non-constant truth tables.
 
     :param data: a length 2^k dictionary mapping an input state to a 1-D numpy array histogram, all defined by the same bin values
     :param bin_vals: representative points in the bins defining the histograms in data
+    :param scorer: optional EMDScorer for bin_vals, reused across calls with the same bins (see make_graph)
     :return: list of tuples of a real valued normalized cut score with its associated truth table
     '''
-    graph = make_graph(data,bin_vals)
+    graph = make_graph(data,bin_vals,scorer)
     inputstates = [k for k in data]
     partitions = calculate_partitions(inputstates)
     scores = []
@@ -190,6 +256,470 @@ def rank_noncst_tables(data,bin_vals):
     return sorted(scores, key=lambda x : x[0])
 
 
+def similarity_matrix(data,bin_vals,scorer=None):
+    '''
+    Make the symmetric matrix of pairwise similarity values, the dense counterpart of make_graph().
+
+    :param data: a length 2^k dictionary mapping an input state to a 1-D numpy array histogram, all defined by the same bin values
+    :param bin_vals: representative points in the bins defining the histograms in data
+    :param scorer: an EMDScorer for bin_vals; default is EMDScorer(bin_vals, "pyemd")
+    :return: N x N numpy array W with zero diagonal, rows and columns in the order of the keys of data
+    '''
+    if scorer is None:
+        scorer = EMDScorer(bin_vals, "pyemd")
+    W = similarity(scorer.pairwise([data[k] for k in data]))
+    np.fill_diagonal(W, 0)
+    return W
+
+
+def partition_matrix(inputstates):
+    '''
+    Encode the output of calculate_partitions() as a Boolean matrix.
+
+    :param inputstates: a list with an even number of elements, N
+    :return: (2^(N-1) - 1) x N Boolean numpy array, row i is the indicator of the i-th partition of calculate_partitions()
+    '''
+    index = dict((k,i) for i,k in enumerate(inputstates))
+    partitions = calculate_partitions(inputstates)
+    X = np.zeros((len(partitions), len(inputstates)), dtype=bool)
+    for r,p in enumerate(partitions):
+        X[r, [index[k] for k in p]] = True
+    return X
+
+
+def _ordered_sum(a):
+    # sum over the last axis in sequence, as the built-in sum does, so the summation order matches the dict code
+    return np.cumsum(a, axis=-1)[..., -1]
+
+
+def normalized_cuts(X, W):
+    '''
+    Calculate the normalized cut score of every partition at once.
+
+    The edge weights are taken from the upper triangle of W in the order make_graph() produces them and summed in that
+    order, so the scores equal those of normalized_cut() up to round-off (the vectorized similarities can differ from
+    the scalar ones in the last bit).
+
+    :param X: P x N Boolean partition matrix (see partition_matrix())
+    :param W: N x N symmetric similarity matrix, or a stack of them with shape (..., N, N)
+    :return: numpy array of P scores, or shape (..., P) for stacked W
+    '''
+    I, J = np.triu_indices(X.shape[1], 1)
+    w = np.asarray(W)[..., I, J][..., np.newaxis, :]
+    inp, inq = X[:, I], X[:, J]
+    Wpq = _ordered_sum(np.where(inp != inq, w, 0.0))
+    WpV = _ordered_sum(np.where(inp | inq, w, 0.0))
+    WqV = _ordered_sum(np.where(~inp | ~inq, w, 0.0))
+    return Wpq * (1.0/WpV + 1.0/WqV)
+
+
+def assign_0or1_all(X, hists, bin_vals):
+    '''
+    Vectorized assign_0or1() for every partition at once.
+
+    :param X: P x N Boolean partition matrix (see partition_matrix()), or a stack with shape (..., P, N)
+    :param hists: N x (number of bins) array of histograms in input state order, or a stack with shape (..., N, bins)
+    :param bin_vals: representative points in the bins defining the histograms
+    :return: integer numpy array of 0s and 1s with shape (..., P)
+    '''
+    hists = np.asarray(hists, dtype=float)[..., np.newaxis, :, :]
+    hp = _ordered_sum(np.where(X[..., np.newaxis], hists, 0.0).swapaxes(-1, -2))
+    hq = _ordered_sum(np.where(X[..., np.newaxis], 0.0, hists).swapaxes(-1, -2))
+    mp = _ordered_sum(hp * bin_vals) / _ordered_sum(hp)
+    mq = _ordered_sum(hq * bin_vals) / _ordered_sum(hq)
+    return np.where(mp < mq, 0, 1)
+
+
+def rank_noncst_tables_matrix(data,bin_vals,scorer=None):
+    '''
+    Matrix version of rank_noncst_tables() with the same output up to round-off in the scores. Partitions are kept in
+    the order of calculate_partitions() and sorted stably, so exact ties are broken the same way.
+
+    :param data: a length 2^k dictionary mapping an input state to a 1-D numpy array histogram, all defined by the same bin values
+    :param bin_vals: representative points in the bins defining the histograms in data
+    :param scorer: optional EMDScorer for bin_vals (see make_graph)
+    :return: list of tuples of a real valued normalized cut score with its associated truth table
+    '''
+    inputstates = [k for k in data]
+    X = partition_matrix(inputstates)
+    hists = np.array([data[k] for k in inputstates], dtype=float)
+    ncuts = normalized_cuts(X, similarity_matrix(data, bin_vals, scorer))
+    bits = assign_0or1_all(X, hists, np.asarray(bin_vals, dtype=float))
+    scores = []
+    for r in np.argsort(ncuts, kind="stable"):
+        b = int(bits[r])
+        truthtable = dict((k, b if X[r,i] else (b + 1) % 2) for i,k in enumerate(inputstates))
+        scores.append( ( ncuts[r], truthtable ) )
+    return scores
+
+
+def bootstrap_scores(pool, choices, desiredtt, inputstates, bin_vals, scorer=None, chunksize=None, similarities=None):
+    '''
+    Score many random circuits drawn from one pool of histograms. The pairwise distances within the pool are computed
+    once and each draw is scored by looking up its similarity matrix, so no graph or truth table dictionaries are made.
+    Draw b gives the same answer as rank_noncst_tables() on dict(zip(inputstates, [pool[i] for i in choices[b]])), up
+    to round-off in the separation.
+
+    :param pool: a list or 2-D numpy array of K histograms, all defined by the same bin values
+    :param choices: B x N integer array; row b lists the pool indices of the histograms for inputstates in draw b
+    :param desiredtt: a dictionary of input states keying Boolean values
+    :param inputstates: a list of the N input states
+    :param bin_vals: representative points in the bins defining the histograms in pool
+    :param scorer: an EMDScorer for bin_vals; default is EMDScorer(bin_vals, "pyemd") as in make_graph()
+    :param chunksize: number of draws scored together; default keeps the working arrays to a few million entries
+    :param similarities: optional K x K matrix similarity(scorer.pairwise(pool)), to reuse it across calls on one pool
+    :return: a length B Boolean numpy array that is True where the top scoring table is desiredtt, and a length B
+             numpy array of separations (second best minus best normalized cut score)
+    '''
+    if scorer is None:
+        scorer = EMDScorer(bin_vals, "pyemd")
+    pool = np.asarray(pool, dtype=float)
+    choices = np.asarray(choices)
+    bin_vals = np.asarray(bin_vals, dtype=float)
+    S = similarity(scorer.pairwise(pool)) if similarities is None else similarities
+    X = partition_matrix(inputstates)
+    desired = np.array([desiredtt[k] for k in inputstates])
+    if chunksize is None:
+        chunksize = max(1, 2**22 // (X.shape[0] * X.shape[1]**2))
+    correct = np.zeros(len(choices), dtype=bool)
+    separation = np.zeros(len(choices))
+    for start in range(0, len(choices), chunksize):
+        c = choices[start:start+chunksize]
+        ncuts = normalized_cuts(X, S[c[:, :, np.newaxis], c[:, np.newaxis, :]])
+        order = np.argsort(ncuts, axis=1, kind="stable")
+        rows = np.arange(len(c))
+        best, second = order[:, 0], order[:, 1]
+        bits = assign_0or1_all(X[best][:, np.newaxis, :], pool[c], bin_vals)[:, 0]
+        tables = np.where(X[best], bits[:, np.newaxis], (bits[:, np.newaxis] + 1) % 2)
+        correct[start:start+chunksize] = np.all(tables == desired, axis=1)
+        separation[start:start+chunksize] = ncuts[rows, second] - ncuts[rows, best]
+    return correct, separation
+
+
+def seed_sequence(seed=None):
+    '''
+    :param seed: None (fresh entropy), an int, a numpy SeedSequence, or a numpy Generator (which is advanced by one
+    draw to derive the sequence)
+    :return: numpy SeedSequence
+    '''
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        return np.random.SeedSequence(seed.integers(2**63, size=4).tolist())
+    return np.random.SeedSequence(seed)
+
+
+def child_seed(seedseq, k):
+    '''
+    The k-th child of a SeedSequence, the same as seedseq.spawn(k + 1)[k] on a fresh seedseq. Unlike spawn, seedseq is
+    not changed, so a SeedSequence can be passed again and gives the same children.
+
+    :param seedseq: numpy SeedSequence
+    :param k: non-negative integer
+    :return: numpy SeedSequence
+    '''
+    return np.random.SeedSequence(seedseq.entropy, spawn_key=tuple(seedseq.spawn_key) + (k,),
+                                  pool_size=seedseq.pool_size)
+
+
+def group_seeds(seed, num_groups):
+    '''
+    :param seed: see seed_sequence
+    :param num_groups: number of groups of histograms to be bootstrapped
+    :return: list of independent SeedSequences, one per group
+    '''
+    root = seed_sequence(seed)
+    return [child_seed(root, g) for g in range(num_groups)]
+
+
+def keyed_seeds(seed, keys):
+    '''
+    :param seed: see seed_sequence
+    :param keys: list of group keys
+    :return: list of SeedSequences, one per key. The stream of a group depends only on seed and str(key), not on the
+    other groups or their order, so adding or removing a group leaves the draws of the others unchanged.
+    '''
+    root = seed_sequence(seed)
+    return [child_seed(root, int(hashlib.sha256(str(k).encode()).hexdigest()[:8], 16)) for k in keys]
+
+
+def bootstrap_block(args):
+    '''
+    Draw and score one block of random circuits (see bootstrap_groups).
+
+    :param args: (pool, sizes, desiredtt, inputstates, bin_vals, num_draws, seedseq, similarities, skip), where sizes
+    lists the number of histograms of each input state in pool (stored in inputstates order), or is None to draw every
+    input state from the whole pool, similarities is the similarity matrix of the pool (see pool_similarities), and the
+    first skip draws of the stream are left out, so a block can be drawn in pieces
+    :return: output of bootstrap_scores
+    '''
+    pool, sizes, desiredtt, inputstates, bin_vals, num_draws, seedseq, similarities, skip = args
+    rng = np.random.default_rng(seedseq)
+    if sizes is None:
+        choices = rng.integers(0, len(pool), size=(skip + num_draws, len(inputstates)))[skip:]
+    else:
+        sizes = np.asarray(sizes)
+        choices = np.cumsum(sizes) - sizes + rng.integers(0, sizes, size=(skip + num_draws, len(inputstates)))[skip:]
+    return bootstrap_scores(pool, choices, desiredtt, inputstates, bin_vals, similarities=similarities)
+
+
+def pool_similarities(groups, bin_vals):
+    # similarity matrix of the pool of each of groups (see bootstrap_groups), computed once per group with the
+    # closed form EMD and shared by all of its blocks
+    scorer = EMDScorer(bin_vals)
+    return [similarity(scorer.pairwise(pool)) for pool, _, _ in groups]
+
+
+def bootstrap_groups(groups, inputstates, bin_vals, num_choices, seeds, workers=1, blocksize=50):
+    '''
+    Score num_choices random circuits for each group. The draws of a group are split into blocks of blocksize, and
+    block b of group g draws from child_seed(seeds[g], b). Blocks are the unit of work on the process
+    pool, so the output is the same for any number of workers (but depends on blocksize).
+
+    :param groups: list of (pool, sizes, desiredtt) as in bootstrap_block
+    :param inputstates: a list of the N input states
+    :param bin_vals: representative points in the bins defining the histograms
+    :param num_choices: number of random circuits per group
+    :param seeds: one SeedSequence per group (see group_seeds)
+    :param workers: number of processes
+    :param blocksize: number of draws per block
+    :return: list of (correct, separation) numpy arrays per group, as returned by bootstrap_scores
+    '''
+    jobs, owners = [], []
+    for g, ((pool, sizes, desiredtt), ss, S) in enumerate(zip(groups, seeds, pool_similarities(groups, bin_vals))):
+        num_blocks = -(-num_choices // blocksize)
+        for b in range(num_blocks):
+            num_draws = min(blocksize, num_choices - b*blocksize)
+            jobs.append((pool, sizes, desiredtt, inputstates, bin_vals, num_draws, child_seed(ss, b), S, 0))
+            owners.append(g)
+    if workers == 1:
+        blocks = [bootstrap_block(job) for job in jobs]
+    else:
+        with multiprocessing.Pool(workers) as p:
+            blocks = p.map(bootstrap_block, jobs, chunksize=1)
+    return _gather_blocks(len(groups), owners, blocks)
+
+
+def _gather_blocks(num_groups, owners, blocks):
+    results = []
+    for g in range(num_groups):
+        mine = [blk for o, blk in zip(owners, blocks) if o == g]
+        results.append((np.concatenate([c for c, _ in mine] or [np.zeros(0, dtype=bool)]),
+                        np.concatenate([sep for _, sep in mine] or [np.zeros(0)])))
+    return results
+
+
+def bootstrap_halfwidths(correct, separation, z=1.96):
+    '''
+    Half-widths of approximate confidence intervals for the fraction of draws that give the desired truth table
+    (normal approximation) and for the median separation (distribution free, from order statistics).
+
+    :param correct: Boolean numpy array from bootstrap_scores
+    :param separation: numpy array from bootstrap_scores
+    :param z: standard normal quantile of the confidence level, 1.96 for 95%
+    :return: (half-width for the fraction correct, half-width for the median separation); infinite with no draws
+    '''
+    n = len(correct)
+    if not n:
+        return np.inf, np.inf
+    p = correct.mean()
+    # the +1 keeps the interval from collapsing to zero width when every draw so far agrees
+    frac = z * np.sqrt((p * (1 - p) + 1.0 / n) / n)
+    x = np.sort(separation)
+    lo = int(max(0, np.floor(n / 2.0 - z * np.sqrt(n) / 2)))
+    hi = int(min(n - 1, np.ceil(n / 2.0 + z * np.sqrt(n) / 2)))
+    return frac, (x[hi] - x[lo]) / 2.0
+
+
+def bootstrap_groups_adaptive(groups, inputstates, bin_vals, num_choices, seeds, tol, median_tol=None, workers=1,
+                              blocksize=50, min_choices=None, max_choices=None):
+    '''
+    Adaptive version of bootstrap_groups. The total budget is num_choices draws per group, drawn in rounds of one block
+    per unsettled group. Every group first gets min(min_choices, num_choices) draws. A group is settled once it has at
+    least min_choices draws and the confidence intervals of its fraction correct and of its median separation (see
+    bootstrap_halfwidths) are within tol and median_tol. The rest of the budget goes to unsettled groups, most
+    uncertain first, up to max_choices per group.
+
+    Draws are taken from the blocks of bootstrap_groups in order, finishing a block that was cut short before starting
+    the next one, so the output is the same for any number of workers and each group's draws are a prefix of what
+    bootstrap_groups would draw with enough num_choices.
+
+    :param tol: largest allowed half-width of the confidence interval of the fraction correct
+    :param median_tol: largest allowed half-width of the confidence interval of the median separation, in units of the
+    separation (a difference of normalized cut scores); default tol
+    :param min_choices: least number of draws per group before stopping; default 2 * blocksize
+    :param max_choices: most draws per group; default 4 * num_choices
+    See bootstrap_groups for the other parameters.
+    :return: list of (correct, separation) numpy arrays per group, as returned by bootstrap_scores
+    '''
+    if median_tol is None:
+        median_tol = tol
+    if min_choices is None:
+        min_choices = 2 * blocksize
+    if max_choices is None:
+        max_choices = 4 * num_choices
+    budget = num_choices * len(groups)
+    first = min(min_choices, num_choices)
+    if first < 1 or max_choices < first or budget < first * len(groups):
+        raise ValueError("A budget of {} draws per group cannot give every group its first {} draws.".format(
+            num_choices, first))
+    drawn = [0] * len(groups)
+    similarities = pool_similarities(groups, bin_vals)
+    owners, blocks = [], []
+    results = _gather_blocks(len(groups), owners, blocks)
+    p = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        while budget > 0:
+            uncertainty = []
+            for g, (correct, separation) in enumerate(results):
+                frac, med = bootstrap_halfwidths(correct, separation)
+                if drawn[g] < max_choices and (drawn[g] < min_choices or frac > tol or med > median_tol):
+                    # groups that have not had their first draws go before everything else
+                    uncertainty.append((drawn[g] >= first, -max(frac / tol, med / median_tol), g))
+            if not uncertainty:
+                break
+            jobs, round_owners = [], []
+            for _, _, g in sorted(uncertainty):
+                limit = first if drawn[g] < first else max_choices
+                # the next draw of group g is draw skip of its block b (see bootstrap_groups)
+                b, skip = divmod(drawn[g], blocksize)
+                num_draws = min(blocksize - skip, limit - drawn[g], budget)
+                if num_draws <= 0:
+                    break
+                pool, sizes, desiredtt = groups[g]
+                jobs.append((pool, sizes, desiredtt, inputstates, bin_vals, num_draws, child_seed(seeds[g], b),
+                             similarities[g], skip))
+                round_owners.append(g)
+                drawn[g] += num_draws
+                budget -= num_draws
+            blocks.extend(p.map(bootstrap_block, jobs, chunksize=1) if p else [bootstrap_block(j) for j in jobs])
+            owners.extend(round_owners)
+            results = _gather_blocks(len(groups), owners, blocks)
+    finally:
+        if p:
+            p.close()
+            p.join()
+    return results
+
+
+def get_input_states(num_inputs):
+    '''
+    :param num_inputs: number of inputs to the gate
+    :return: list of the 2^num_inputs input states as bit strings in counting order, e.g. ["00", "01", "10", "11"]
+    '''
+    return ["".join(p) for p in itertools.product("01", repeat=num_inputs)]
+
+
+def _ncut(cut, volp, volq):
+    # normalized cut from the cut weight and the volumes (sums of degrees) of the two sets; with volumes, the
+    # weight_to_all() of a set is (vol + cut) / 2
+    return cut * (2.0/(volp + cut) + 2.0/(volq + cut))
+
+
+def gray_code_cuts(W):
+    '''
+    Generate every 2-partition of the vertices of W with its normalized cut score. Partitions are visited in Gray code
+    order, so consecutive partitions differ by moving one vertex and the cut is updated in O(N) time instead of being
+    recomputed. The last vertex is always outside the partition, so each partition appears once.
+
+    :param W: N x N symmetric similarity matrix with zero diagonal
+    :return: generator of (mask, score), where bit i of the integer mask is set if vertex i is in the partition
+    '''
+    W = np.asarray(W, dtype=float)
+    N = W.shape[0]
+    deg = W.sum(axis=1)
+    total = deg.sum()
+    top = np.zeros(N)  # weight from each vertex into the partition
+    cut = volp = 0.0
+    mask = 0
+    for i in range(1, 2**(N-1)):
+        v = (i & -i).bit_length() - 1
+        if mask >> v & 1:
+            top -= W[v]
+            cut += 2*top[v] - deg[v]
+            volp -= deg[v]
+        else:
+            cut += deg[v] - 2*top[v]
+            top += W[v]
+            volp += deg[v]
+        mask ^= 1 << v
+        yield mask, _ncut(cut, volp, total - volp)
+
+
+def spectral_cuts(W):
+    '''
+    Score the N - 1 threshold partitions of the Fiedler vector of the normalized graph Laplacian of W (Shi and Malik).
+    This is used instead of gray_code_cuts() when there are too many input states to visit every partition.
+
+    :param W: N x N symmetric similarity matrix with zero diagonal
+    :return: list of (mask, score) as in gray_code_cuts()
+    '''
+    W = np.asarray(W, dtype=float)
+    N = W.shape[0]
+    deg = W.sum(axis=1)
+    dinv = 1.0 / np.sqrt(deg)
+    L = np.eye(N) - dinv[:, np.newaxis] * W * dinv
+    _, vecs = np.linalg.eigh(L)
+    order = np.argsort(dinv * vecs[:, 1], kind="stable")
+    cuts = []
+    mask = 0
+    for v in order[:-1]:
+        mask |= 1 << int(v)
+        # keep the last vertex outside the partition as in gray_code_cuts()
+        m = mask ^ (2**N - 1) if mask >> (N-1) & 1 else mask
+        X = np.array([[m >> i & 1 for i in range(N)]], dtype=bool)
+        cuts.append((m, normalized_cuts(X, W)[0]))
+    return cuts
+
+
+def top_k_cuts(cuts, k):
+    '''
+    Keep the k lowest scoring partitions without storing or sorting all of them. Ties are kept in the order generated.
+
+    :param cuts: iterable of (mask, score)
+    :param k: number of partitions to keep
+    :return: list of (mask, score) sorted by score
+    '''
+    heap = []
+    for t, (mask, score) in enumerate(cuts):
+        if len(heap) < k:
+            heapq.heappush(heap, (-score, -t, mask))
+        elif score < -heap[0][0]:
+            heapq.heapreplace(heap, (-score, -t, mask))
+    return [(mask, -s) for s, _, mask in sorted(heap, key=lambda x: (-x[0], -x[1]))]
+
+
+def rank_noncst_tables_topk(data,bin_vals,k=10,scorer=None,max_exhaustive=20):
+    '''
+    Return the k best scored non-constant truth tables for any number of input states. Up to max_exhaustive states,
+    all 2^(N-1) - 1 partitions are scored with gray_code_cuts(); above that spectral_cuts() proposes N - 1 candidates.
+    The returned scores are recomputed exactly with normalized_cuts(). The best tables are the same as those of
+    rank_noncst_tables(), but exact ties may be listed in a different order.
+
+    :param data: a length 2^k dictionary mapping an input state to a 1-D numpy array histogram, all defined by the same bin values
+    :param bin_vals: representative points in the bins defining the histograms in data
+    :param k: number of tables to return
+    :param scorer: optional EMDScorer for bin_vals (see make_graph)
+    :param max_exhaustive: largest number of input states for which every partition is scored
+    :return: list of at most k tuples of a real valued normalized cut score with its associated truth table
+    '''
+    inputstates = [k_ for k_ in data]
+    N = len(inputstates)
+    W = similarity_matrix(data, bin_vals, scorer)
+    cuts = gray_code_cuts(W) if N <= max_exhaustive else spectral_cuts(W)
+    best = top_k_cuts(cuts, k)
+    X = np.array([[m >> i & 1 for i in range(N)] for m, _ in best], dtype=bool).reshape(-1, N)
+    hists = np.array([data[s] for s in inputstates], dtype=float)
+    ncuts = normalized_cuts(X, W)
+    bits = assign_0or1_all(X, hists, np.asarray(bin_vals, dtype=float))
+    scores = []
+    for r in np.argsort(ncuts, kind="stable"):
+        b = int(bits[r])
+        truthtable = dict((s, b if X[r,i] else (b + 1) % 2) for i,s in enumerate(inputstates))
+        scores.append( ( ncuts[r], truthtable ) )
+    return scores
+
+
 def print_scores(scores):
     for ns,tt in scores:
         print(ns)
@@ -226,5 +756,29 @@ def test():
     print_scores(scores)
 
 
+def test_bootstrap_adaptive():
+    # every group must get draws, also when num_choices is below min_choices
+    bin_vals = np.array([float(r) for r in range(12)])
+    rng = np.random.default_rng(0)
+    inputstates = get_input_states(2)
+    desiredtt = {"00": 0, "01": 1, "10": 1, "11": 1}
+    groups = [(rng.integers(0, 20, size=(8, 12)).astype(float), [2, 2, 2, 2], desiredtt) for _ in range(4)]
+    for num_choices in [25, 50, 250]:
+        results = bootstrap_groups_adaptive(groups, inputstates, bin_vals, num_choices, group_seeds(1, len(groups)),
+                                            0.05)
+        counts = [len(c) for c, _ in results]
+        assert all(n > 0 for n in counts), counts
+        assert all(n >= min(100, num_choices) for n in counts), counts
+        assert sum(counts) <= num_choices * len(groups), counts
+    # the draws of each group are a prefix of those of bootstrap_groups, also when blocks are cut short
+    seeds = group_seeds(2, len(groups))
+    full = bootstrap_groups(groups, inputstates, bin_vals, 400, seeds)
+    for (c, s), (fc, fs) in zip(bootstrap_groups_adaptive(groups, inputstates, bin_vals, 100, seeds, 0.05,
+                                                          min_choices=30, max_choices=400), full):
+        assert np.array_equal(c, fc[:len(c)]) and np.array_equal(s, fs[:len(s)]), len(c)
+    print("test_bootstrap_adaptive passed")
+
+
 if __name__ == "__main__":
-    test()
\ No newline at end of file
+    test()
+    test_bootstrap_adaptive()
\ No newline at end of file
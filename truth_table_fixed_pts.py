@@ -21,6 +21,8 @@
 # SOFTWARE.
 
 import DSGRN,itertools,json,os,contextlib
+import numpy
+from paramio import save_params
 
 def truth_table_constructor_2in(in1, topval1, in2, topval2, out, topvalout):
     '''
@@ -47,15 +49,40 @@ def truth_table_constructor_2in(in1, topval1, in2, topval2, out, topvalout):
         truthtables.append(tuple(temp))
     return truthtables
 
-def truth_table_query(database,bounds):
+def bound_bitmap(database,bound):
+    '''
+    :param database: A DSGRN database.
+    :param bound: A bound in DSGRN dictionary format.
+    :return: a boolean numpy array of length parametergraph.size() that is True at the parameters matching the bound
+    '''
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            DSGRN.Query.FixedPointTables.MatchQuery(bound, "tempFP", database)
+    c = database.conn.cursor()
+    sqlexpression = 'select ParameterIndex from tempFP natural join Signatures;'
+    bitmap = numpy.zeros(database.parametergraph.size(), dtype=bool)
+    bitmap[numpy.fromiter((row[0] for row in c.execute(sqlexpression)), dtype=numpy.int64)] = True
+    c.execute("drop table tempFP")
+    return bitmap
+
+
+def truth_table_query(database,bounds,bitmap=False):
     '''
     This function only works for fixed points with non-overlapping bounds.
     See DSGRN.DoubleFixedPointQuery for a technique when there are overlapping bounds.
     :param database: A DSGRN database.
     :param bounds: A list of bounds in DSGRN dictionary format.
-    :return: a list of parameter indices with the matching truth table
+    :param bitmap: True or False. Intersect boolean arrays over all parameters instead of Python sets, which uses
+                   far less memory for large parameter graphs.
+    :return: a set of parameter indices with the matching truth table, or a boolean array over all parameter indices
+             if bitmap is True
     '''
     #FIXME: Add check that bounds do not overlap (they shouldn't for truth tables)
+    if bitmap:
+        matches = bound_bitmap(database,bounds[0])
+        for bound in bounds[1:]:
+            numpy.logical_and(matches, bound_bitmap(database,bound), out=matches)
+        return matches
     for k,bound in enumerate(bounds):
         with open(os.devnull, 'w') as devnull:
             with contextlib.redirect_stdout(devnull):
@@ -71,6 +98,62 @@ def truth_table_query(database,bounds):
     return matches
 
 
+def get_distinct_bounds(truthtables):
+    '''
+    :param truthtables: A list of lists of bounds in DSGRN dictionary format.
+    :return: the list of distinct bounds and, for each truth table, the sorted list of indices of its bounds in it
+    '''
+    bound_ids = {}
+    distinct_bounds = []
+    table_ids = []
+    for bounds in truthtables:
+        ids = set()
+        for bound in bounds:
+            key = json.dumps(sorted(bound.items()))
+            if key not in bound_ids:
+                bound_ids[key] = len(distinct_bounds)
+                distinct_bounds.append(bound)
+            ids.add(bound_ids[key])
+        table_ids.append(sorted(ids))
+    return distinct_bounds, table_ids
+
+
+def batched_truth_table_queries(database,truthtables,bitmap=False):
+    '''
+    Query all truth tables at once. Truth tables share most of their bounds (the 16 two input tables have only 8
+    distinct bounds), so each distinct bound is matched against the database exactly once and the results are stored
+    in a single indexed table of (BoundId, ParameterIndex). The parameters of each truth table are the ones that
+    match all of its bounds, which is found with GROUP BY/HAVING.
+    This function only works for fixed points with non-overlapping bounds (see truth_table_query).
+
+    :param database: A DSGRN database.
+    :param truthtables: A list of lists of bounds in DSGRN dictionary format.
+    :param bitmap: True or False. Keep one boolean array over all parameters per distinct bound and intersect them with
+                   bitwise ANDs instead of querying the match table.
+    :return: a list of sets of parameter indices, or of boolean arrays if bitmap is True, one for each truth table
+    '''
+    distinct_bounds, table_ids = get_distinct_bounds(truthtables)
+    if bitmap:
+        bitmaps = [bound_bitmap(database,bound) for bound in distinct_bounds]
+        return [numpy.logical_and.reduce([bitmaps[k] for k in ids]) for ids in table_ids]
+    c = database.conn.cursor()
+    c.execute("create temp table BoundMatches (BoundId integer, ParameterIndex integer)")
+    for k,bound in enumerate(distinct_bounds):
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                DSGRN.Query.FixedPointTables.MatchQuery(bound, "tempFP", database)
+        c.execute("insert into BoundMatches select distinct ?, ParameterIndex from tempFP natural join Signatures;", (k,))
+        c.execute("drop table tempFP")
+    c.execute("create index BoundMatchesIndex on BoundMatches (BoundId, ParameterIndex)")
+    all_matches = []
+    for ids in table_ids:
+        sqlexpression = 'select ParameterIndex from BoundMatches where BoundId in ({}) group by ParameterIndex ' \
+                        'having count(BoundId) = ?;'.format(",".join("?" * len(ids)))
+        all_matches.append(set([row[0] for row in c.execute(sqlexpression, ids + [len(ids)])]))
+    c.execute("drop table BoundMatches")
+    return all_matches
+
+
 def format_truth_table(tt,in1,in2,out):
     '''
     Makes the truth table look nice.
@@ -84,7 +167,8 @@ def format_truth_table(tt,in1,in2,out):
     return "".join(l)
 
 
-def do_all_queries(dbname, in1, topval1, in2, topval2, out, topvalout, print_output=False):
+def do_all_queries(dbname, in1, topval1, in2, topval2, out, topvalout, print_output=False, batched=False, bitmap=False,
+                   fmt="json"):
     '''
     Take a database and record the parameters for each of the possible 16 truth tables for two inputs.
 
@@ -96,6 +180,9 @@ def do_all_queries(dbname, in1, topval1, in2, topval2, out, topvalout, print_out
     :param out: String with the name of the output variable.
     :param topvalout: Highest value of the output variable.
     :param print_output: True or False. Print the output for each truth table in pretty format
+    :param batched: True or False. Query each distinct bound once for all truth tables (see batched_truth_table_queries)
+    :param bitmap: True or False. Intersect parameter sets as boolean arrays (see truth_table_query)
+    :param fmt: "json" or "binary". The binary params file is memory-mappable and is read with paramio.load_params.
 
     :return: File names where the results are deposited. The keys to each json dictionary are
              integers that link truth tables in one file to parameters in the second file.
@@ -108,10 +195,17 @@ def do_all_queries(dbname, in1, topval1, in2, topval2, out, topvalout, print_out
     truthtables = truth_table_constructor_2in(in1, topval1, in2, topval2, out, topvalout)
     all_matches = []
     lengths = []
-    for bounds in truthtables:
-        matches = truth_table_query(database, bounds)
-        all_matches.append(sorted(list(matches)))
-        lengths.append(len(matches))
+    if batched:
+        table_matches = batched_truth_table_queries(database, truthtables, bitmap)
+    else:
+        table_matches = (truth_table_query(database, bounds, bitmap) for bounds in truthtables)
+    for matches in table_matches:
+        # keep each table's matches as a sorted numpy array; Python lists of ints would take several times the memory
+        if bitmap:
+            all_matches.append(numpy.flatnonzero(matches))
+        else:
+            all_matches.append(numpy.sort(numpy.fromiter(matches, dtype=numpy.int64, count=len(matches))))
+        lengths.append(int(all_matches[-1].size))
     np = database.parametergraph.size()
     if print_output:
         for l, tt in sorted(zip(lengths,truthtables),key=lambda t : t[0],reverse=True):
@@ -119,9 +213,22 @@ def do_all_queries(dbname, in1, topval1, in2, topval2, out, topvalout, print_out
                 print("Parameters with specified truth table: {}/{} = {:.2f}%\n".format(l, np,l/np*100))
                 print(format_truth_table(tt,in1,in2,out))
     sum_file = 'summary_{}.json'.format(dbname[:-3])
-    param_file = 'params_{}.json'.format(dbname[:-3])
+    if fmt == "json":
+        param_file = 'params_{}.json'.format(dbname[:-3])
+    elif fmt == "binary":
+        param_file = 'params_{}.params'.format(dbname[:-3])
+    else:
+        raise ValueError("Format {} not recognized.".format(fmt))
     D = {"database" : dbname, "num_params" : np }
     D.update( { k : (l,t) for (k,t),l in zip(enumerate(truthtables),lengths) } )
     json.dump(D, open(sum_file,'w'))
-    json.dump({ k : a for k,a in enumerate(all_matches)}, open(param_file,'w'))
+    if fmt == "json":
+        # same output as json.dump of the dictionary of lists, converting one table to a list at a time
+        with open(param_file,'w') as f:
+            f.write("{")
+            for k,a in enumerate(all_matches):
+                f.write("{}{}: {}".format(", " if k else "", json.dumps(str(k)), json.dumps(a.tolist())))
+            f.write("}")
+    else:
+        save_params(all_matches, param_file, np)
     return sum_file,param_file
@@ -24,7 +24,9 @@
 import sys
 # sys.path.append('/home/jupyter/tacc-work/jupyter_packages/lib/python3.6/site-packages')
 import DSGRN, graphviz
-import progressbar, json, subprocess
+import progressbar, json, subprocess, multiprocessing, hashlib, os, sqlite3, time
+import numpy
+from paramio import save_params
 
 def is_FP(annotation):
     return annotation.startswith("FP")
@@ -34,25 +36,303 @@ def is_FP_match(state, annotation):
     return all(digits[k] >= state[k][0] and digits[k] <= state[k][1]
            for k in state)
 
-def get_matching_truthtables(parametergraph,truthtables,N):
+def get_stable_FP_annotations(parametergraph,p):
+    parameter = parametergraph.parameter(p)
+    dg = DSGRN.DomainGraph(parameter)
+    md = DSGRN.MorseDecomposition(dg.digraph())
+    mg = DSGRN.MorseGraph(dg, md)
+    return [mg.annotation(i)[0] for i in range(0, mg.poset().size())
+            if is_FP(mg.annotation(i)[0]) and len(mg.poset().children(i)) == 0]
+
+def get_truthtable_bounds(truthtables):
+    '''
+    Stack the states of all truth tables into lower and upper bound arrays of shape (tables x states x dims).
+    Network variables that a state does not constrain get the bounds [0, max int], and a table with fewer states than
+    the others is padded by repeating its states (which does not change whether it matches).
+
+    :param truthtables: list of tuples of state dictionaries keyed by network index
+    :return: tuple of integer arrays (lower, upper)
+    '''
+    D = max(k for states in truthtables for state in states for k in state) + 1
+    S = max(len(states) for states in truthtables)
+    lower = numpy.zeros((len(truthtables), S, D), dtype=numpy.int64)
+    upper = numpy.full((len(truthtables), S, D), numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+    for t, states in enumerate(truthtables):
+        for s in range(S):
+            for k, (lo, hi) in states[s % len(states)].items():
+                lower[t, s, k] = lo
+                upper[t, s, k] = hi
+    return lower, upper
+
+def parse_FP_annotations(stable_FP_annotations):
+    # one row of integer coordinates per fixed point
+    return numpy.array([[int(s) for s in a.replace(",", "").split() if s.isdigit()] for a in stable_FP_annotations],
+                       dtype=numpy.int64)
+
+def match_FP_vectors(FPs,lower,upper):
+    '''
+    Test all truth tables at once: a table matches if every one of its states contains at least one fixed point.
+
+    :param FPs: integer array (fixed points x network dimension), the output of parse_FP_annotations
+    :param lower: lower bounds from get_truthtable_bounds
+    :param upper: upper bounds from get_truthtable_bounds
+    :return: boolean array with one entry per truth table
+    '''
+    if not len(FPs):
+        return numpy.zeros(lower.shape[0], dtype=bool)
+    FPs = FPs[:, :lower.shape[2]]
+    inside = ((FPs >= lower[:, :, None, :]) & (FPs <= upper[:, :, None, :])).all(axis=3)
+    return inside.any(axis=2).all(axis=1)
+
+def match_truthtables(stable_FP_annotations,truthtables,bounds=None):
+    # bounds is the output of get_truthtable_bounds(truthtables), which can be passed in to avoid rebuilding it
+    lower, upper = bounds if bounds else get_truthtable_bounds(truthtables)
+    return numpy.flatnonzero(match_FP_vectors(parse_FP_annotations(stable_FP_annotations),lower,upper)).tolist()
+
+def network_hash(net_str):
+    return hashlib.sha256(net_str.strip().encode()).hexdigest()
+
+class FPCache(object):
+    '''
+    Persistent cache of the stable FP annotations of each parameter of a network, stored in an sqlite file and keyed
+    by (hash of the network specification, parameter index). The annotations do not depend on the truth tables, so
+    any truth table query of a cached network is a scan of this table instead of a Morse graph computation.
+    If max_entries is given, every put evicts the least recently used entries so that the file stays bounded during
+    a sweep.
+    '''
+
+    def __init__(self,cachefile,net_str,max_entries=None):
+        self.cachefile = cachefile
+        self.max_entries = max_entries
+        self.network = network_hash(net_str)
+        self.conn = sqlite3.connect(cachefile, timeout=600)
+        self.conn.execute("create table if not exists FPCache (Network text, ParameterIndex integer, "
+                          "Annotations text, LastUsed real, primary key (Network, ParameterIndex))")
+        self.conn.execute("create index if not exists FPCacheLastUsed on FPCache (LastUsed)")
+        self.conn.commit()
+
+    def get(self,start,stop):
+        '''
+        :return: dictionary of the cached parameter indices in range(start,stop) keying lists of stable FP annotations
+        '''
+        c = self.conn.cursor()
+        rows = c.execute("select ParameterIndex, Annotations from FPCache where Network = ? and ParameterIndex >= ? "
+                         "and ParameterIndex < ?", (self.network, start, stop)).fetchall()
+        if rows:
+            c.execute("update FPCache set LastUsed = ? where Network = ? and ParameterIndex >= ? and ParameterIndex < ?",
+                      (time.time(), self.network, start, stop))
+            self.conn.commit()
+        return {p : json.loads(a) for p, a in rows}
+
+    def put(self,annotations):
+        '''
+        :param annotations: dictionary of parameter indices keying lists of stable FP annotations
+        '''
+        now = time.time()
+        self.conn.executemany("insert or replace into FPCache values (?, ?, ?, ?)",
+                              [(self.network, p, json.dumps(a), now) for p, a in annotations.items()])
+        self.conn.commit()
+        if self.max_entries:
+            self.evict(self.max_entries)
+
+    def evict(self,max_entries):
+        '''
+        Delete the least recently used entries (over all networks) until at most max_entries remain.
+        '''
+        N = self.conn.execute("select count(*) from FPCache").fetchone()[0]
+        if N > max_entries:
+            self.conn.execute("delete from FPCache where rowid in (select rowid from FPCache order by LastUsed limit ?)",
+                              (N - max_entries,))
+            self.conn.commit()
+
+    def invalidate(self,all_networks=False):
+        '''
+        Delete the cached annotations of this network, or of every network if all_networks is True.
+        '''
+        if all_networks:
+            self.conn.execute("delete from FPCache")
+        else:
+            self.conn.execute("delete from FPCache where Network = ?", (self.network,))
+        self.conn.commit()
+        self.conn.execute("vacuum")
+
+    def close(self):
+        self.conn.close()
+
+def match_parameter_range(parametergraph,truthtables,start,stop,cache=None):
+    params = [[] for _ in range(len(truthtables))]
+    bounds = get_truthtable_bounds(truthtables)
+    annotations = cache.get(start,stop) if cache else {}
+    computed = {}
+    for p in range(start,stop):
+        if p not in annotations:
+            annotations[p] = computed[p] = get_stable_FP_annotations(parametergraph,p)
+        for k in match_truthtables(annotations[p],truthtables,bounds):
+            params[k].append(p)
+    if cache and computed:
+        cache.put(computed)
+    return params
+
+def get_matching_truthtables(parametergraph,truthtables,N,cache=None,chunksize=1000):
+    # cache is an optional FPCache of the network of parametergraph
     params = [[] for _ in range(len(truthtables))]
     bar = progressbar.ProgressBar(max_value=N)
-    for p in range(N):
-        bar.update(p)
-        parameter = parametergraph.parameter(p)
-        dg = DSGRN.DomainGraph(parameter)
-        md = DSGRN.MorseDecomposition(dg.digraph())
-        mg = DSGRN.MorseGraph(dg, md)
-        stable_FP_annotations = [mg.annotation(i)[0] for i in range(0, mg.poset().size())
-                                 if is_FP(mg.annotation(i)[0]) and len(mg.poset().children(i)) == 0]
-        for k,states in enumerate(truthtables):
-            if all(any([is_FP_match(v,a) for a in stable_FP_annotations]) for v in states):
-                params[k].append(p)
+    for start, stop in get_chunks(N,chunksize):
+        bar.update(start)
+        for k, c in enumerate(match_parameter_range(parametergraph,truthtables,start,stop,cache)):
+            params[k].extend(c)
     bar.finish()
     return params
 
-def results(net_str,circuit,truthtables,displaygraph=False):
+def get_chunks(N,chunksize,start=0):
+    return [(s, min(s + chunksize, N)) for s in range(start, N, chunksize)]
+
+# DSGRN objects cannot be pickled, so each worker process rebuilds the parameter graph once from the network string
+_worker = {}
+
+def _init_worker(net_str,truthtables,cachefile,cache_size):
+    network = DSGRN.Network()
+    network.assign(net_str)
+    _worker["parametergraph"] = DSGRN.ParameterGraph(network)
+    _worker["truthtables"] = truthtables
+    _worker["cache"] = FPCache(cachefile,net_str,cache_size) if cachefile else None
+
+def _match_chunk(chunk):
+    return chunk, match_parameter_range(_worker["parametergraph"],_worker["truthtables"],*chunk,cache=_worker["cache"])
+
+def iter_chunk_matches(net_str,parametergraph,truthtables,chunks,workers=1,cachefile=None,cache_size=None):
+    # yields (chunk, params) pairs as chunks finish; the order is arbitrary when workers > 1
+    if workers == 1:
+        cache = FPCache(cachefile,net_str,cache_size) if cachefile else None
+        for chunk in chunks:
+            yield chunk, match_parameter_range(parametergraph,truthtables,*chunk,cache=cache)
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(net_str,truthtables,cachefile,cache_size)) as pool:
+            for chunk, params in pool.imap_unordered(_match_chunk, chunks):
+                yield chunk, params
+
+def get_matching_truthtables_parallel(net_str,truthtables,N,workers=None,chunksize=1000,cachefile=None,cache_size=None):
+    '''
+    Parallel version of get_matching_truthtables. The parameter indices range(N) are split into chunks that are
+    processed on a pool of worker processes and the per truth table matches are merged.
+
+    :param net_str: DSGRN network specification string (the parameter graph is rebuilt in each worker)
+    :param truthtables: list of tuples of state dictionaries keyed by network index, as in get_matching_truthtables
+    :param N: number of parameters to search
+    :param workers: number of processes; None uses all available cores
+    :param chunksize: number of parameter indices handed to a worker at a time
+    :param cachefile: optional sqlite file of an FPCache shared by the workers
+    :param cache_size: optional maximum number of entries of the FPCache, enforced after every chunk
+    :return: list of sorted lists of parameter indices, one for each truth table (same as get_matching_truthtables)
+    '''
+    params = [[] for _ in range(len(truthtables))]
+    bar = progressbar.ProgressBar(max_value=N)
+    done = 0
+    for (start, stop), chunk_params in iter_chunk_matches(net_str,None,truthtables,get_chunks(N,chunksize),workers,
+                                                          cachefile,cache_size):
+        for k, c in enumerate(chunk_params):
+            params[k].extend(c)
+        done += stop - start
+        bar.update(done)
+    bar.finish()
+    return [sorted(p) for p in params]
+
+def checkpoint_key(net_str,truthtables):
+    tt = [[sorted(state.items()) for state in states] for states in truthtables]
+    return hashlib.sha256(json.dumps([net_str,tt]).encode()).hexdigest()
+
+def read_checkpoint(checkpoint,key,num_tables):
+    '''
+    Read an append-only checkpoint file written by get_matching_truthtables_checkpointed. The first line is a header
+    identifying the network and truth tables, every other line is a finished chunk and its matches. A partially
+    written last line (from a killed job) is ignored.
+
+    :return: list of finished (start, stop) ranges and the list of matches per truth table found in them
+    '''
+    finished = []
+    params = [[] for _ in range(num_tables)]
+    if not os.path.exists(checkpoint):
+        return finished, params
+    with open(checkpoint) as f:
+        lines = f.readlines()
+    if lines:
+        header = json.loads(lines[0])
+        if header["key"] != key:
+            raise ValueError("Checkpoint {} was written for a different network or set of truth tables.".format(checkpoint))
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        finished.append(tuple(record["chunk"]))
+        for k, c in enumerate(record["params"]):
+            params[k].extend(c)
+    return finished, params
+
+def get_remaining_chunks(finished,N,chunksize):
+    chunks = []
+    start = 0
+    for a, b in sorted(finished) + [(N, N)]:
+        chunks.extend(get_chunks(a,chunksize,start))
+        start = max(start, b)
+    return chunks
+
+def get_matching_truthtables_checkpointed(net_str,parametergraph,truthtables,N,checkpoint,workers=1,chunksize=1000,cachefile=None,
+                                          cache_size=None):
+    '''
+    Resumable version of get_matching_truthtables. Each finished chunk of parameter indices is appended to the
+    checkpoint file, and a restarted run with the same network and truth tables skips the chunks already recorded.
+
+    :param net_str: DSGRN network specification string
+    :param parametergraph: DSGRN.ParameterGraph of net_str (used when workers == 1)
+    :param truthtables: list of tuples of state dictionaries keyed by network index
+    :param N: number of parameters to search
+    :param checkpoint: file name of the append-only checkpoint (JSON lines)
+    :param workers: number of processes; None uses all available cores
+    :param chunksize: number of parameter indices per checkpointed chunk
+    :param cachefile: optional sqlite file of an FPCache
+    :param cache_size: optional maximum number of entries of the FPCache, enforced after every chunk
+    :return: list of sorted lists of parameter indices, one for each truth table
+    '''
+    key = checkpoint_key(net_str,truthtables)
+    finished, params = read_checkpoint(checkpoint,key,len(truthtables))
+    chunks = get_remaining_chunks(finished,N,chunksize)
+    done = N - sum(stop - start for start, stop in chunks)
+    if finished:
+        print("Resuming from {}: {}/{} parameters already done.".format(checkpoint,done,N))
+    torn = False
+    if os.path.exists(checkpoint) and os.path.getsize(checkpoint):
+        with open(checkpoint,'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
+    bar = progressbar.ProgressBar(max_value=N)
+    with open(checkpoint,'a') as f:
+        if torn:
+            # terminate the partial record of a killed run so the next record starts on its own line
+            f.write("\n")
+        if not f.tell():
+            f.write(json.dumps({"key" : key, "network" : net_str, "num_params" : N}) + "\n")
+        for (start, stop), chunk_params in iter_chunk_matches(net_str,parametergraph,truthtables,chunks,workers,cachefile,
+                                                              cache_size):
+            f.write(json.dumps({"chunk" : [start, stop], "params" : chunk_params}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            for k, c in enumerate(chunk_params):
+                params[k].extend(c)
+            done += stop - start
+            bar.update(done)
+    bar.finish()
+    return [sorted(p) for p in params]
+
+def results(net_str,circuit,truthtables,displaygraph=False,workers=1,chunksize=1000,checkpoint=None,cachefile=None,
+            cache_size=None,fmt="json"):
     # truth tables is list of dictionaries
+    # workers is the number of processes for the parameter sweep; None uses all cores
+    # checkpoint is an optional file name; finished chunks are appended to it and a rerun resumes from it
+    # cachefile is an optional FPCache file of stable FP annotations, kept to at most cache_size entries after every chunk
+    # fmt is "json" or "binary" (memory-mappable, see paramio.load_params) for the params file
+    if fmt not in ["json", "binary"]:
+        raise ValueError("Format {} not recognized.".format(fmt))
     datetime = subprocess.check_output(['date +%Y_%m_%d_%H_%M_%S'], shell=True).decode(sys.stdout.encoding).strip()
     network = DSGRN.Network()
     network.assign(net_str)
@@ -66,7 +346,15 @@ def results(net_str,circuit,truthtables,displaygraph=False):
         for name, state in states.items():
             state_dicts.append({network.index(str(k)): state[k] for k in state})
         tt.append(tuple(state_dicts))
-    params = get_matching_truthtables(pg,tt,np)
+    if checkpoint:
+        params = get_matching_truthtables_checkpointed(net_str,pg,tt,np,checkpoint,workers=workers,chunksize=chunksize,
+                                                       cachefile=cachefile,cache_size=cache_size)
+    elif workers == 1:
+        cache = FPCache(cachefile,net_str,cache_size) if cachefile else None
+        params = get_matching_truthtables(pg,tt,np,cache=cache,chunksize=chunksize)
+    else:
+        params = get_matching_truthtables_parallel(net_str,tt,np,workers=workers,chunksize=chunksize,cachefile=cachefile,
+                                                   cache_size=cache_size)
     for k,t in enumerate(tt):
         l = len(params[k])
         print("Truth table:")
@@ -75,4 +363,7 @@ def results(net_str,circuit,truthtables,displaygraph=False):
     D = {"network" : net_str}
     D.update( { k : t for k,t in enumerate(truthtables)} )
     json.dump(D, open('metadata{}_{}.json'.format(datetime,circuit),'w'))
-    json.dump(params, open('params{}_{}.json'.format(datetime,circuit),'w'))
+    if fmt == "json":
+        json.dump(params, open('params{}_{}.json'.format(datetime,circuit),'w'))
+    else:
+        save_params(params, 'params{}_{}.params'.format(datetime,circuit), np)